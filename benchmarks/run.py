@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+
+# Benchmarks for collect, push and fetch, repeatable on any Linux box:
+# - collectors read recorded command output and /proc files from benchmarks/fixtures, rather than the system
+# - the database is filled with a synthetic history of hosts x measurements x samples, in a SQLite database
+#   for each host, or in an empty MariaDB database given with --database
+# Timings are written as JSON, to compare between versions.
+
+import argparse
+import builtins
+from datetime import *
+import os
+import os.path
+import platform
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+fixtures_dir = os.path.join(benchmarks_dir, 'fixtures')
+sys.path.insert(0, os.path.dirname(benchmarks_dir))
+
+from systemmonitor.common import *
+from systemmonitor.database import Database, fetch_hosts
+import systemmonitor.collector
+import systemmonitor.database
+import systemmonitor.devices
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmarks/run.py')
+
+    parser.add_argument('--hosts', dest='hosts', type=int, default=4, help='number of hosts in the synthetic history (default: 4)')
+    parser.add_argument('--measurements', dest='measurements', type=int, default=200, help='number of measurements per sample (default: 200)')
+    parser.add_argument('--samples', dest='samples', type=int, default=1000, help='number of samples per host (default: 1000)')
+    parser.add_argument('--interval', dest='interval', type=int, default=600, help='seconds between samples (default: 600)')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5, help='number of times each benchmark is run (default: 5)')
+    parser.add_argument('--layout', dest='layouts', action='append', choices=['legacy', 'normalized'], help='database layout to benchmark (can be given more than once, default: both)')
+    parser.add_argument('--database', dest='database', help='benchmark against the MariaDB database configured for this host, which must be empty, rather than SQLite (only one host)')
+    parser.add_argument('--seed', dest='seed', type=int, default=1, help='seed for the synthetic history (default: 1)')
+    parser.add_argument('--output', dest='output', help='file to write timings to (default: stdout)')
+
+    args = parser.parse_args()
+
+    if args.database is not None and args.hosts != 1:
+        parser.error('--database can only be used with --hosts 1')
+
+    work_dir = tempfile.mkdtemp(prefix='systemmonitor-benchmarks-')
+    try:
+        results = run(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            write_json(results, fh)
+    else:
+        write_json(results)
+
+def run(args, work_dir):
+    try:
+        commit = cmd('git -C {} describe --always --dirty'.format(os.path.dirname(benchmarks_dir)))
+    except CommandException:
+        commit = None
+
+    results = {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': 'sqlite' if args.database is None else 'mariadb',
+        'parameters': {
+            'hosts': args.hosts,
+            'measurements': args.measurements,
+            'samples': args.samples,
+            'interval': args.interval,
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': {},
+    }
+
+    # Collect
+    collect_config = {
+        'collect': {
+            'concurrent': True,
+        },
+        'smart': {
+            'cache': os.path.join(work_dir, 'smart.json'),
+            # Always query smartctl, so it's parsed on every run
+            'ttl': {'health': 0, 'attributes': 0},
+        },
+    }
+    systemmonitor.collector.get_config = lambda host: collect_config
+    collector = systemmonitor.collector.Collector()
+    Replay().install()
+    collectors = sorted([c for c in collector.collectors if c.__name__ != 'OpenRazerCollector'], key=lambda c: c.__name__)
+    for c in collectors:
+        bench(results, 'collect.{}'.format(c.__name__), lambda: collector.run_collector(c), args.repeat)
+    bench(results, 'collect.all', lambda: collector.collect(structured_data=False, collectors=collectors, custom=False), args.repeat)
+    bench(results, 'collect.all.structured', lambda: collector.collect(structured_data=True, collectors=collectors, custom=False), args.repeat)
+    template = collector.collect(structured_data=False, collectors=collectors, custom=False)
+
+    # Push and fetch
+    measurements = synthetic_measurements(template, args.measurements)
+    for layout in args.layouts or ['legacy', 'normalized']:
+        hosts = ['host{}'.format(i) for i in range(args.hosts)]
+        if args.database is None:
+            layout_dir = os.path.join(work_dir, layout)
+            os.mkdir(layout_dir)
+            host_configs = dict([(host, sqlite_config(layout_dir, host, layout)) for host in hosts])
+        else:
+            host_config = dict(get_config(args.database))
+            host_config['db'] = dict(host_config['db'], layout=layout)
+            host_configs = {hosts[0]: host_config}
+        systemmonitor.database.get_config = lambda host: host_configs[host]
+
+        if args.database is not None:
+            check_empty(Database(hosts[0]))
+        try:
+            bench_database(results, args, layout, hosts, measurements)
+        finally:
+            if args.database is not None:
+                empty(Database(hosts[0]))
+            systemmonitor.database.close_read_pool()
+
+    return results
+
+def bench_database(results, args, layout, hosts, measurements):
+    rng = random.Random(args.seed)
+    start = datetime(2021, 1, 1)
+    end = start + timedelta(seconds=args.interval * (args.samples - 1))
+
+    # Fill each host's history, a chunk of samples at a time
+    started = time.perf_counter()
+    rows = 0
+    for host in hosts:
+        database = Database(host, persistent=True)
+        samples = []
+        for sample in synthetic_samples(measurements, args.samples, args.interval, start, rng):
+            samples.append(sample)
+            if len(samples) == 100:
+                rows += database.push_samples(samples)['rows']
+                samples = []
+        if len(samples) > 0:
+            rows += database.push_samples(samples)['rows']
+        database.disconnect_push()
+    seconds = time.perf_counter() - started
+    results['results']['{}.push.history'.format(layout)] = {
+        'runs': 1,
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds,
+    }
+    err("{}.push.history: {} rows in {:.3f}s".format(layout, rows, seconds))
+
+    # A single sample pushed after the history, as collect does
+    database = Database(hosts[0])
+    pushes = synthetic_samples(measurements, args.repeat, args.interval, end + timedelta(seconds=args.interval), rng)
+    def push():
+        taken, data = next(pushes)
+        database.push(data, taken)
+    bench(results, '{}.push'.format(layout), push, args.repeat)
+
+    # Fetches of all samples leave out the first, since counter rates need the sample before.
+    # The pattern matches the measurements under the first one's top two levels.
+    database = Database(hosts[0])
+    middle = start + (end - start) / 2
+    pattern = '.'.join(measurements[0][0].split('.')[0:2])
+    bench(results, '{}.fetch.latest'.format(layout), lambda: database.fetch(samples=1), args.repeat)
+    bench(results, '{}.fetch.all'.format(layout), lambda: database.fetch(samples=args.samples - 1), args.repeat)
+    bench(results, '{}.fetch.range'.format(layout), lambda: database.fetch(start=middle, end=end), args.repeat)
+    bench(results, '{}.fetch.pattern'.format(layout), lambda: database.fetch(samples=args.samples - 1, measurements=[pattern]), args.repeat)
+    bench(results, '{}.fetch.ndjson'.format(layout), lambda: sum(1 for _ in database.iter_fetch(samples=args.samples - 1)), args.repeat)
+    bench(results, '{}.fetch_hosts.latest'.format(layout), lambda: fetch_hosts(hosts, samples=1), args.repeat)
+    bench(results, '{}.aggregate.hourly'.format(layout), lambda: database.aggregate('1h', functions=['min', 'max', 'avg', 'last'], start=start, end=end), args.repeat)
+
+def bench(results, name, function, repeat):
+    times = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    results['results'][name] = {
+        'runs': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'max': max(times),
+    }
+    err("{}: {:.6f}s".format(name, statistics.median(times)))
+
+def synthetic_measurements(template, count):
+    # Names, types and units of collected measurements, repeated under a numbered prefix until there are enough
+    names = sorted(template.keys())
+    measurements = []
+    for i in range(count):
+        name = names[i % len(names)]
+        copy = i // len(names)
+        key = name if copy == 0 else "bench{}.{}".format(copy, name)
+        measurements.append((key, template[name].type, template[name].unit))
+    return measurements
+
+def synthetic_samples(measurements, samples, interval, start, rng):
+    counters = {}
+    for i in range(samples):
+        taken = (start + timedelta(seconds=interval * i)).strftime(datetime_format)
+        data = {}
+        for key, value_type, unit in measurements:
+            if value_type == '%s':
+                counters[key] = counters.get(key, 0) + rng.uniform(0, interval * 100)
+                value = counters[key]
+            elif value_type == '%':
+                value = rng.uniform(0, 100)
+            elif value_type == 'bool':
+                value = rng.random() < 0.99
+            elif value_type == 'bytes':
+                value = rng.randrange(0, 2 ** 40)
+            else:
+                value = round(rng.uniform(0, 1000), 2)
+            data[key] = Measurement(value, value_type, unit=unit)
+        yield (taken, data)
+
+def sqlite_config(directory, host, layout):
+    return {
+        'db': {
+            'backend': 'sqlite',
+            'file': os.path.join(directory, host + '.db'),
+            'layout': layout,
+        },
+    }
+
+def check_empty(database):
+    database.connect_admin()
+    try:
+        cur = database.admin_connection.cursor()
+        for table in ('measurements', 'measurement_names', 'measurement_values', 'measurement_rollups'):
+            cur.execute("SELECT COUNT(*) FROM {}".format(table))
+            if cur.fetchone()[0] > 0:
+                raise Exception("Database for benchmarks must be empty, but {} has rows".format(table))
+    finally:
+        database.disconnect_admin()
+
+def empty(database):
+    database.connect_admin()
+    try:
+        cur = database.admin_connection.cursor()
+        for table in ('measurements', 'measurement_values', 'measurement_names', 'measurement_rollups'):
+            cur.execute("DELETE FROM {}".format(table))
+        database.admin_connection.commit()
+    finally:
+        database.disconnect_admin()
+
+
+class Replay():
+
+    # Recorded output for each command the collectors run, and the /proc files they read
+    commands = [
+        (re.compile(r'^sudo smartctl .* (\S+)$'), lambda m: read_fixture('smartctl_{}.json'.format(os.path.basename(m.group(1))))),
+        (re.compile(r'^lsblk '), lambda m: read_fixture('lsblk.json')),
+        (re.compile(r'^sensors -j$'), lambda m: read_fixture('sensors.json')),
+        (re.compile(r'^ipmitool -c sdr$'), lambda m: read_fixture('ipmitool_sdr.csv')),
+        (re.compile(r'^sudo btrfs filesystem show$'), lambda m: read_fixture('btrfs_filesystem_show.txt')),
+        (re.compile(r'^sudo btrfs device stats (\S+)$'), lambda m: read_fixture('btrfs_device_stats.txt').format(device=m.group(1))),
+    ]
+    files = {
+        '/proc/stat': 'proc_stat',
+        '/proc/meminfo': 'proc_meminfo',
+    }
+
+    def install(self):
+        # Replace cmd, check_installed and open everywhere they've been imported into a systemmonitor module
+        for name, module in list(sys.modules.items()):
+            if name.startswith('systemmonitor'):
+                if hasattr(module, 'cmd'):
+                    module.cmd = self.cmd
+                if hasattr(module, 'check_installed'):
+                    module.check_installed = lambda command: True
+                if name.startswith('systemmonitor.collectors.'):
+                    module.open = self.open
+        # Block devices come from the recorded lsblk output, rather than sysfs
+        systemmonitor.devices.scan_sysfs = systemmonitor.devices.scan_lsblk
+
+    def cmd(self, command, timeout=None):
+        for command_regex, output in self.commands:
+            command_match = command_regex.match(command)
+            if command_match:
+                return output(command_match).rstrip("\n")
+        raise Exception("No recorded output for command: {}".format(command))
+
+    def open(self, filename, *args, **kwargs):
+        if filename in self.files:
+            filename = os.path.join(fixtures_dir, self.files[filename])
+        return builtins.open(filename, *args, **kwargs)
+
+
+def read_fixture(name):
+    with open(os.path.join(fixtures_dir, name)) as fh:
+        return fh.read()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+# Measures how long systemmonitor takes to start - importing the CLI, reading the config and loading the
+# collectors - in fresh interpreters, over the time a bare interpreter takes. Exits with status 1 if the median
+# is over the budget, or if a module that should only be imported when it's needed was imported.
+
+import argparse
+import json
+import os
+import os.path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarks_dir))
+
+from systemmonitor.common import *
+
+startup_code = """
+import json, sys
+import systemmonitor.cli
+from systemmonitor.collector import Collector
+Collector()
+print(json.dumps(sorted(sys.modules.keys())))
+"""
+
+# Modules that aren't needed to start, or to collect
+lazy_modules = ['mariadb', 'sqlite3', 'orjson', 'concurrent.futures', 'inspect', 'pkgutil']
+
+# Only CPUCollector is enabled in the config used, so no other collector's module should be imported
+config = """
+localhost:
+  collect:
+    disabled: [BtrfsCollector, DiskCollector, IPMICollector, MemoryCollector, OpenRazerCollector, SensorsCollector]
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmarks/startup.py')
+
+    parser.add_argument('--runs', dest='runs', type=int, default=20, help='number of interpreters to start (default: 20)')
+    parser.add_argument('--budget', dest='budget', type=float, default=0.1, help='most seconds startup may take, over a bare interpreter (default: 0.1)')
+    parser.add_argument('--output', dest='output', help='file to write timings to (default: stdout)')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='systemmonitor-startup-') as home:
+        os.mkdir(os.path.join(home, '.config'))
+        with open(os.path.join(home, '.config', 'systemmonitor.yml'), 'w') as fh:
+            fh.write(config)
+        # Bytecode is written to a separate directory by a first run, so the timed runs don't include compiling,
+        # as when installed
+        env = dict(os.environ, HOME=home, PYTHONPATH=os.pathsep.join([os.path.dirname(benchmarks_dir)] + os.environ.get('PYTHONPATH', '').split(os.pathsep)),
+            PYTHONPYCACHEPREFIX=os.path.join(home, 'pycache'))
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        time_runs([sys.executable, '-c', startup_code], env, 1)
+
+        baseline = time_runs([sys.executable, '-c', 'pass'], env, args.runs)
+        startup = time_runs([sys.executable, '-c', startup_code], env, args.runs)
+        modules = json.loads(subprocess.run([sys.executable, '-c', startup_code], env=env, check=True, stdout=subprocess.PIPE).stdout)
+
+    collector_modules = [m for m in modules if m.startswith('systemmonitor.collectors.')]
+    imported = [m for m in lazy_modules if m in modules] + [m for m in collector_modules if m != 'systemmonitor.collectors.cpu']
+    seconds = statistics.median(startup) - statistics.median(baseline)
+    results = {
+        'runs': args.runs,
+        'baseline': summarise(baseline),
+        'startup': summarise(startup),
+        'seconds': seconds,
+        'budget': args.budget,
+        'within_budget': seconds <= args.budget,
+        'imported_unneeded': imported,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            write_json(results, fh)
+    else:
+        write_json(results)
+
+    if seconds > args.budget:
+        err("Startup took {:.3f}s, over the budget of {:.3f}s".format(seconds, args.budget))
+    if len(imported) > 0:
+        err("Imported at startup, but not needed:", ', '.join(imported))
+    if seconds > args.budget or len(imported) > 0:
+        sys.exit(1)
+
+def time_runs(command, env, runs):
+    times = []
+    for i in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    return times
+
+def summarise(times):
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'max': max(times),
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -10,10 +10,54 @@ CREATE TABLE monitor.measurements (
 	INDEX (measurement)
 );
 
+# Tables for the normalized layout (db layout: normalized)
+CREATE TABLE monitor.measurement_names (
+	id          INT UNSIGNED NOT NULL AUTO_INCREMENT,
+	measurement VARCHAR(100) NOT NULL,
+	value_type  VARCHAR(10)  NOT NULL,
+	unit        VARCHAR(20),
+	PRIMARY KEY (id),
+	UNIQUE KEY (measurement)
+);
+
+CREATE TABLE monitor.measurement_values (
+	measurement_id INT UNSIGNED NOT NULL,
+	taken          DATETIME     NOT NULL,
+	value          DOUBLE,
+	value_text     VARCHAR(100),
+	PRIMARY KEY (measurement_id, taken),
+	INDEX (taken)
+);
+
+# Hourly and daily rollups of numeric measurements
+CREATE TABLE monitor.measurement_rollups (
+	resolution  VARCHAR(10)  NOT NULL,
+	period      DATETIME     NOT NULL,
+	measurement VARCHAR(100) NOT NULL,
+	value_type  VARCHAR(10)  NOT NULL,
+	unit        VARCHAR(20),
+	min_value   DOUBLE       NOT NULL,
+	max_value   DOUBLE       NOT NULL,
+	avg_value   DOUBLE       NOT NULL,
+	last_value  DOUBLE       NOT NULL,
+	samples     INT UNSIGNED NOT NULL,
+	PRIMARY KEY (resolution, measurement, period),
+	INDEX (resolution, period)
+);
+
 # User for adding data to monitoring
 CREATE USER monitor_insert@'localhost' IDENTIFIED BY 'qwerty' PASSWORD EXPIRE NEVER;
 GRANT INSERT ON monitor.measurements TO 'monitor_insert'@'localhost';
+GRANT SELECT, INSERT ON monitor.measurement_names TO 'monitor_insert'@'localhost';
+GRANT INSERT ON monitor.measurement_values TO 'monitor_insert'@'localhost';
 
 # User for reading data from monitoring
 CREATE USER monitor_select IDENTIFIED BY 'qwerty' PASSWORD EXPIRE NEVER;
 GRANT SELECT ON monitor.measurements TO 'monitor_select';
+GRANT SELECT ON monitor.measurement_names TO 'monitor_select';
+GRANT SELECT ON monitor.measurement_values TO 'monitor_select';
+GRANT SELECT ON monitor.measurement_rollups TO 'monitor_select';
+
+# User for maintenance, such as migrating to the normalized layout and compacting rollups
+CREATE USER monitor_admin@'localhost' IDENTIFIED BY 'qwerty' PASSWORD EXPIRE NEVER;
+GRANT SELECT, INSERT, UPDATE, DELETE ON monitor.* TO 'monitor_admin'@'localhost';
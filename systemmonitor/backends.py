@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+from systemmonitor.common import *
+
+import re
+import threading
+
+
+class MariaDBBackend():
+
+    # A MariaDB (or MySQL) server, with a user for each role. The driver is imported when it's first used.
+
+    needs_users = True
+    default_layout = 'legacy'
+
+    def __init__(self, db_config):
+        import mariadb
+        self.driver = mariadb
+        self.Error = mariadb.Error
+        self.host = db_config['host']
+        self.schema = db_config['schema']
+
+    def connect(self, user, password, autocommit=True):
+        conn = self.driver.connect(
+            user = user,
+            password = password,
+            host = self.host,
+            database = self.schema
+        )
+        if not autocommit:
+            conn.autocommit = False
+        return conn
+
+    def pool_key(self, user):
+        return ('mariadb', self.host, self.schema, user)
+
+    def bucket_sql(self):
+        # Which bucket a sample is in - the number of whole bucket widths (the second parameter, in seconds)
+        # between an origin time (the first parameter) and when it was taken
+        return "TIMESTAMPDIFF(SECOND, ?, taken) DIV ?"
+
+
+class SQLiteBackend():
+
+    # A local SQLite file, in WAL mode so fetches aren't blocked by pushes. There are no users, so every role can
+    # be used. The tables are created when it's first connected to, and connections take the same SQL as MariaDB.
+
+    needs_users = False
+    default_layout = 'normalized'
+
+    def __init__(self, db_config, schema=None):
+        import sqlite3
+        self.driver = sqlite3
+        self.Error = sqlite3.Error
+        self.filename = os.path.expanduser(db_config.get('file', os.path.join(get_cache_dir(), 'systemmonitor.db')))
+        self.timeout = db_config.get('timeout', 30)
+        self.schema = schema or sqlite_schema
+
+    def connect(self, user=None, password=None, autocommit=True):
+        directory = os.path.dirname(self.filename)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        conn = self.driver.connect(self.filename, timeout=self.timeout, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        with sqlite_schema_lock:
+            if self.filename not in sqlite_schema_created:
+                conn.executescript(self.schema)
+                sqlite_schema_created.add(self.filename)
+        return SQLiteConnection(conn)
+
+    def pool_key(self, user):
+        return ('sqlite', self.filename)
+
+    def bucket_sql(self):
+        return "(CAST(strftime('%s', taken) AS INTEGER) - CAST(strftime('%s', ?) AS INTEGER)) / ?"
+
+
+class SQLiteConnection():
+
+    # Wraps a sqlite3 connection to take the MariaDB SQL used by Database, and return times as datetimes
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.autocommit = True
+
+    def cursor(self):
+        return SQLiteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def ping(self):
+        self.conn.execute("SELECT 1")
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLiteCursor():
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.datetime_columns = []
+        # Times are repeated for every measurement in a sample, so each is only parsed once
+        self.datetimes = {}
+
+    def execute(self, query, params=()):
+        self.cur.execute(sqlite_query(query), [sqlite_param(p) for p in params])
+        # Times are stored as text, so columns of times (including MIN() and MAX() of them) are converted back
+        self.datetime_columns = []
+        if self.cur.description is not None:
+            self.datetime_columns = [i for i, column in enumerate(self.cur.description)
+                if 'taken' in column[0] or 'period' in column[0]]
+        return self
+
+    def executemany(self, query, params):
+        self.cur.executemany(sqlite_query(query), [[sqlite_param(p) for p in row] for row in params])
+
+    def convert(self, row):
+        if row is None or len(self.datetime_columns) == 0:
+            return row
+        row = list(row)
+        for i in self.datetime_columns:
+            value = row[i]
+            if isinstance(value, str):
+                if value not in self.datetimes:
+                    self.datetimes[value] = datetime.fromisoformat(value)
+                row[i] = self.datetimes[value]
+        return tuple(row)
+
+    def fetchone(self):
+        return self.convert(self.cur.fetchone())
+
+    def fetchall(self):
+        return [self.convert(row) for row in self.cur.fetchall()]
+
+    def __iter__(self):
+        return (self.convert(row) for row in self.cur)
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+
+def sqlite_query(query):
+    # The MariaDB statements that SQLite writes differently
+    query = query.replace('INSERT IGNORE', 'INSERT OR IGNORE')
+    delete_limit_match = sqlite_delete_limit_regex.match(query)
+    if delete_limit_match:
+        query = "DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} WHERE {1} LIMIT ?)".format(delete_limit_match.group(1), delete_limit_match.group(2))
+    return query
+
+def sqlite_param(param):
+    # Stored in the same format as MariaDB returns them, so they sort and compare as times
+    if isinstance(param, datetime):
+        return str(param)
+    return param
+
+def get_backend(db_config):
+    name = db_config.get('backend', 'mariadb')
+    if name not in backends:
+        raise Exception("Invalid database backend: {}".format(name))
+    return backends[name](db_config)
+
+
+sqlite_delete_limit_regex = re.compile(r'^DELETE FROM (\w+) WHERE (.*) LIMIT \?$', re.S)
+
+# Files whose tables have been created by this process
+sqlite_schema_created = set()
+sqlite_schema_lock = threading.Lock()
+
+# The same tables as systemmonitor.sql
+sqlite_schema = """
+CREATE TABLE IF NOT EXISTS measurements (
+	taken       DATETIME     NOT NULL,
+	measurement VARCHAR(100) NOT NULL,
+	value_type  VARCHAR(10)  NOT NULL,
+	value       VARCHAR(100) NOT NULL,
+	unit        VARCHAR(20)
+);
+CREATE INDEX IF NOT EXISTS measurements_taken ON measurements (taken);
+CREATE INDEX IF NOT EXISTS measurements_measurement ON measurements (measurement);
+
+CREATE TABLE IF NOT EXISTS measurement_names (
+	id          INTEGER      PRIMARY KEY AUTOINCREMENT,
+	measurement VARCHAR(100) NOT NULL UNIQUE,
+	value_type  VARCHAR(10)  NOT NULL,
+	unit        VARCHAR(20)
+);
+
+CREATE TABLE IF NOT EXISTS measurement_values (
+	measurement_id INTEGER      NOT NULL,
+	taken          DATETIME     NOT NULL,
+	value          DOUBLE,
+	value_text     VARCHAR(100),
+	PRIMARY KEY (measurement_id, taken)
+);
+CREATE INDEX IF NOT EXISTS measurement_values_taken ON measurement_values (taken);
+
+CREATE TABLE IF NOT EXISTS measurement_rollups (
+	resolution  VARCHAR(10)  NOT NULL,
+	period      DATETIME     NOT NULL,
+	measurement VARCHAR(100) NOT NULL,
+	value_type  VARCHAR(10)  NOT NULL,
+	unit        VARCHAR(20),
+	min_value   DOUBLE       NOT NULL,
+	max_value   DOUBLE       NOT NULL,
+	avg_value   DOUBLE       NOT NULL,
+	last_value  DOUBLE       NOT NULL,
+	samples     INTEGER      NOT NULL,
+	PRIMARY KEY (resolution, measurement, period)
+);
+CREATE INDEX IF NOT EXISTS measurement_rollups_period ON measurement_rollups (resolution, period);
+"""
+
+backends = {
+    'mariadb': MariaDBBackend,
+    'sqlite': SQLiteBackend,
+}
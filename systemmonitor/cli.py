@@ -2,55 +2,195 @@
 
 from systemmonitor.common import *
 from systemmonitor.collector import Collector
-from systemmonitor.database import Database
+from systemmonitor.daemon import Daemon
+from systemmonitor.database import Database, aggregate_functions, fetch_hosts, get_database_hosts
+from systemmonitor.spool import Spool
 
 import argparse
+import cProfile
 from datetime import *
-import json
 
 
 def main():
     parser = argparse.ArgumentParser(prog='systemmonitor')
 
-    parser.add_argument('action', choices=['collect', 'fetch'], help='action to perform')
-    parser.add_argument('host', nargs='?', help='host to fetch data for')
-    parser.add_argument('--output', dest='output', choices=['database', 'json'], default='json', help='where the collected data is output to (default: json)')
-    parser.add_argument('--samples', dest='samples', type=int, default=1, help='number of samples to fetch from database (default: 1)')
+    parser.add_argument('action', choices=['collect', 'daemon', 'replay', 'fetch', 'aggregate', 'migrate', 'compact', 'prune'], help='action to perform')
+    parser.add_argument('hosts', metavar='host', nargs='*', help='host(s) to fetch data for, or host to aggregate, migrate, compact or prune (default for these: localhost)')
+    parser.add_argument('--all', dest='all_hosts', action='store_true', help='fetch data for all hosts with a read database configured')
+    parser.add_argument('--output', dest='output', choices=['database', 'spool', 'json'], default='json', help='where the collected data is output to (default: json)')
+    parser.add_argument('--format', dest='format', choices=['json', 'ndjson'], default='json', help='format of JSON output - ndjson writes one measurement per line as it is read (default: json)')
+    parser.add_argument('--samples', dest='samples', type=int, help='number of samples to fetch from database (default: 1, unless --start is given) - with the daemon, each sample only has the collectors that were due')
+    parser.add_argument('--start', dest='start', help='fetch samples from this time, either absolute (\'2021-01-31 12:00:00\') or relative to now (\'6h\')')
+    parser.add_argument('--end', dest='end', help='fetch samples up to this time')
+    parser.add_argument('--measurement', dest='measurements', action='append', help='only fetch measurements matching this pattern - * is a wildcard, otherwise matches the measurement and everything under it (can be given more than once)')
+    parser.add_argument('--resolution', dest='resolution', help='fetch from the coarsest rollup at least this fine (e.g. \'1h\', \'1d\'), rather than raw samples')
+    parser.add_argument('--aggregate', dest='aggregate', choices=['min', 'max', 'avg', 'last'], default='avg', help='value of each rollup period to fetch (default: avg)')
+    parser.add_argument('--bucket', dest='bucket', default='1h', help='width of each bucket to aggregate samples into (default: 1h)')
+    parser.add_argument('--function', dest='functions', action='append', choices=list(aggregate_functions), help='function to aggregate each bucket with - rate is for \'%%s\' counters (can be given more than once, default: avg)')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, help='number of samples to migrate, or rows to prune, at a time (default: 100 samples, 1000 rows)')
+    parser.add_argument('--verbose', dest='verbose', action='store_true', help='output timings to stderr')
+    parser.add_argument('--profile', dest='profile', help='write a cProfile dump of the run to this file')
 
     args = parser.parse_args()
 
+    if args.profile is None:
+        sys.exit(run(args))
+
+    # Written even if the run fails, or the daemon is stopped
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        exit_code = run(args)
+    finally:
+        profile.disable()
+        profile.dump_stats(args.profile)
+    sys.exit(exit_code)
+
+def run(args):
     action = args.action
-    host = args.host
+    hosts = args.hosts
+    host = hosts[0] if len(hosts) > 0 else None
     output = args.output
+    output_format = args.format
     samples = args.samples
+    verbose = args.verbose
 
     if action == 'collect':
-        collect(output)
+        # Collectors are run one at a time when profiling, as only this thread is profiled
+        collect(output, verbose, output_format=output_format, sequential=(args.profile is not None))
+    elif action == 'daemon':
+        Daemon().run()
+    elif action == 'replay':
+        replay(verbose)
     elif action == 'fetch':
-        fetch(host, samples)
+        if samples is None and args.start is None:
+            samples = 1
+        if args.all_hosts:
+            hosts = get_database_hosts()
+        if args.all_hosts or len(hosts) > 1:
+            return fetch_multiple(hosts, samples, start=args.start, end=args.end, measurements=args.measurements, resolution=args.resolution, aggregate=args.aggregate, output_format=output_format)
+        fetch(host, samples, start=args.start, end=args.end, measurements=args.measurements, resolution=args.resolution, aggregate=args.aggregate, output_format=output_format)
+    elif action == 'aggregate':
+        if args.start is None:
+            fail("Need to specify --start to aggregate")
+        aggregate(host or 'localhost', args.bucket, args.functions or ['avg'], start=args.start, end=args.end, measurements=args.measurements, output_format=output_format)
+    elif action == 'migrate':
+        migrate(host or 'localhost', args.chunk_size or 100, verbose)
+    elif action == 'compact':
+        compact(host or 'localhost', start=args.start, verbose=verbose)
+    elif action == 'prune':
+        prune(host or 'localhost', args.chunk_size or 1000, verbose)
     else:
         fail("Not recognised action:", action)
+    return 0
 
-def collect(output):
+def collect(output, verbose=False, output_format='json', sequential=False):
     now = datetime.now().strftime(datetime_format)
     collector = Collector()
-    need_structured_data = output != 'database'
+    if sequential:
+        collector.concurrent = False
+    need_structured_data = output == 'json' and output_format == 'json'
     data = collector.collect(structured_data=need_structured_data)
 
     if output == 'json':
         # Write data to console in JSON format
-        out(json.dumps(data, cls=DateTimeEncoder, sort_keys=True, indent=4))
+        if output_format == 'ndjson':
+            write_ndjson(measurement_records(sorted(data.items())))
+        else:
+            write_json(data)
     elif output == 'database':
-        # Insert data into DB
+        # Insert data into DB - if that fails and a spool is configured, write the data there instead
         database = Database('localhost')
-        database.push(data, now)
+        try:
+            stats = database.push(data, now)
+        except Exception as e:
+            if 'spool' not in collector.local_config:
+                raise e
+            err("Failed to push data, writing it to spool:", e)
+            spool_data(collector.local_config['spool'], data, now)
+            return
+        if verbose:
+            err("Pushed {rows} measurements in {batches} batches in {seconds:.3f}s".format(**stats))
+    elif output == 'spool':
+        # Write data to the local spool, to be pushed to the DB by replay
+        spool_data(collector.local_config.get('spool', {}), data, now)
     else:
         fail("Not recognised output:", output)
 
-def fetch(host, samples):
+def spool_data(spool_config, data, now):
+    spool = Spool(spool_config)
+    try:
+        spool.append(data, now)
+    finally:
+        spool.close()
+
+def replay(verbose=False):
+    spool = Spool(get_config('localhost').get('spool', {}))
+    database = Database('localhost', persistent=True)
+    total = spool.replay(database, verbose=verbose)
+    if database.push_connection is not None:
+        database.disconnect_push()
+    err("Replayed {} samples".format(total))
+
+def fetch(host, samples, start=None, end=None, measurements=None, resolution=None, aggregate='avg', output_format='json'):
+    database = Database(host)
+    if output_format == 'ndjson':
+        # Each measurement is written as soon as its history has been read
+        write_ndjson(measurement_records(database.iter_fetch(samples=samples, start=start, end=end, measurements=measurements, resolution=resolution, aggregate=aggregate)))
+    else:
+        res = database.fetch(samples=samples, start=start, end=end, measurements=measurements, resolution=resolution, aggregate=aggregate)
+        write_json(res)
+    database.save_fetch_stats()
+
+def fetch_multiple(hosts, samples, start=None, end=None, measurements=None, resolution=None, aggregate='avg', output_format='json'):
+    # Hosts are fetched from concurrently. Data is output for each host that worked, keyed by host,
+    # and errors for the others are written to stderr.
+    res, errors = fetch_hosts(hosts, samples=samples, start=start, end=end, measurements=measurements, resolution=resolution, aggregate=aggregate,
+        structured_data=(output_format == 'json'))
+    if output_format == 'ndjson':
+        write_ndjson(host_records(res))
+    else:
+        write_json(res)
+    for host in sorted(errors.keys()):
+        err("Failed to fetch data for {}:".format(host), errors[host])
+    if len(errors) > 0:
+        return 1
+    return 0
+
+def host_records(res):
+    for host in sorted(res.keys()):
+        for record in measurement_records(sorted(res[host].items())):
+            record['host'] = host
+            yield record
+
+def aggregate(host, bucket, functions, start, end=None, measurements=None, output_format='json'):
+    database = Database(host)
+    res = database.aggregate(bucket, functions=functions, start=start, end=end, measurements=measurements, structured_data=(output_format == 'json'))
+    if output_format == 'ndjson':
+        write_ndjson(function_records(res))
+    else:
+        write_json(res)
+
+def function_records(res):
+    for function in sorted(res.keys()):
+        for record in measurement_records(sorted(res[function].items())):
+            record['function'] = function
+            yield record
+
+def migrate(host, chunk_size, verbose=False):
+    database = Database(host)
+    total = database.migrate(chunk_size=chunk_size, verbose=verbose)
+    err("Migrated {} rows".format(total))
+
+def compact(host, start=None, verbose=False):
+    database = Database(host)
+    rows = database.compact(start=start, verbose=verbose)
+    err("Updated {} rollup rows".format(rows))
+
+def prune(host, chunk_size, verbose=False):
     database = Database(host)
-    res = database.fetch(samples=samples)
-    out(json.dumps(res, cls=DateTimeEncoder, sort_keys=True, indent=4))
+    rows = database.prune(chunk_size=chunk_size, verbose=verbose)
+    err("Pruned {} rows".format(rows))
 
 
 if __name__ == '__main__':
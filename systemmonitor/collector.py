@@ -1,13 +1,28 @@
 #!/usr/bin/python3
 
 from systemmonitor.common import *
+from systemmonitor.devices import reset_block_devices
 
 from datetime import *
 from importlib import import_module
-import inspect
+import os
 import os.path
-import pkgutil
 import re
+import threading
+import time
+
+
+# The module each collector is in, so only the collectors that are enabled need to be imported.
+# Modules under collectors/ that aren't listed are imported and scanned for collectors.
+collector_registry = {
+    'BtrfsCollector': 'btrfs',
+    'CPUCollector': 'cpu',
+    'DiskCollector': 'disk',
+    'IPMICollector': 'ipmi',
+    'MemoryCollector': 'memory',
+    'OpenRazerCollector': 'openrazer',
+    'SensorsCollector': 'sensors',
+}
 
 
 class Collector():
@@ -16,34 +31,78 @@ class Collector():
         # Load config
         local_config = get_config('localhost')
         self.local_config = local_config
+        collect_config = {}
+        if local_config is not None and 'collect' in local_config:
+            collect_config = local_config['collect']
+        self.concurrent = collect_config.get('concurrent', True)
+        self.timeout = collect_config.get('timeout', 60)
+        self.timeouts = collect_config.get('timeouts', {})
+        self.self_measurements = collect_config.get('self_measurements', True)
+        self.disabled = set(collect_config.get('disabled', []))
+        # Collectors that are running, so one that's hung isn't started again alongside itself
+        self.running = set()
+        self.running_lock = threading.Lock()
+        # Rates of counters can be worked out as they're collected, so readers don't need the sample before
+        self.counter_rates = None
+        if 'counter_rates' in collect_config:
+            from systemmonitor.counters import CounterRates
+            self.counter_rates = CounterRates(collect_config['counter_rates'])
         self.collectors = set()
-        self.scan_for_collectors([
-            os.path.dirname(__file__) + '/collectors',
-        ])
-
-    def scan_for_collectors(self, scan_dirs):
-        for (_, module_name, _) in pkgutil.iter_modules(scan_dirs):
-            package_name = 'systemmonitor.collectors'
-            imported_module = import_module("{}.{}".format(package_name, module_name))
-
-            for i in dir(imported_module):
-                collector = getattr(imported_module, i)
-                if inspect.isclass(collector) and collector != AbstractCollector and issubclass(collector, AbstractCollector):
-                    self.collectors.add(collector)
-
-    def collect(self, structured_data=True):
+        self.load_collectors(os.path.dirname(__file__) + '/collectors')
+
+    def load_collectors(self, collectors_dir):
+        package_name = 'systemmonitor.collectors'
+        for name, module_name in collector_registry.items():
+            if name not in self.disabled:
+                self.collectors.add(getattr(import_module("{}.{}".format(package_name, module_name)), name))
+
+        registered_modules = set(collector_registry.values())
+        for filename in sorted(os.listdir(collectors_dir)):
+            module_name, extension = os.path.splitext(filename)
+            if extension == '.py' and module_name not in registered_modules:
+                self.scan_for_collectors(import_module("{}.{}".format(package_name, module_name)))
+
+    def scan_for_collectors(self, imported_module):
+        import inspect
+        for i in dir(imported_module):
+            collector = getattr(imported_module, i)
+            if inspect.isclass(collector) and collector != AbstractCollector and issubclass(collector, AbstractCollector) and collector.__name__ not in self.disabled:
+                self.collectors.add(collector)
+
+    def collect(self, structured_data=True, collectors=None, custom=True):
+        # Runs all collectors and custom methods, unless a subset of collectors is given, or custom is False
         data = dict()
-
-        # Run all collectors
-        for collector in sorted(list(self.collectors), key=lambda x: x.__name__.lower()):
-            collector().collect(data)
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        reset_block_devices()
+
+        # Run all collectors, then merge their data in name order so the output is deterministic
+        if collectors is None:
+            collectors = self.collectors
+        collectors = sorted(list(collectors), key=lambda x: x.__name__.lower())
+        if self.concurrent:
+            results = self.run_concurrently(collectors)
+        else:
+            results = [self.run_collector(collector) for collector in collectors]
+        for collector_data in results:
+            data.update(collector_data)
+        if self.counter_rates is not None:
+            self.counter_rates.save()
 
         # Custom collection
-        if self.local_config is not None and 'custom' in self.local_config:
+        if custom and self.local_config is not None and 'custom' in self.local_config:
             for key, custom_config in self.local_config['custom'].items():
                 params = custom_config['input']
                 if custom_config['method'] == 'file_date_modified':
-                    self.data_file_date_modified(data, key, *params)
+                    self.measure(data, "custom.{}".format(key), self.data_file_date_modified, data, key, *params)
+
+        # Totals for the whole run
+        if self.self_measurements:
+            self_data = [(k, m) for k, m in data.items() if k.startswith('systemmonitor.self.')]
+            data['systemmonitor.self.collect.wall_time'] = Measurement(time.perf_counter() - started, 'raw', unit='s')
+            data['systemmonitor.self.collect.cpu_time'] = Measurement(time.process_time() - cpu_started, 'raw', unit='s')
+            data['systemmonitor.self.collect.commands'] = Measurement(sum([m.value for k, m in self_data if k.endswith('.commands')]), 'raw')
+            data['systemmonitor.self.collect.measurements'] = Measurement(float(len(data) - len(self_data)), 'raw')
 
         # Return data, structured hierarchically if required
         if structured_data:
@@ -51,6 +110,91 @@ class Collector():
         return data
 
 
+    def get_timeout(self, collector):
+        return self.timeouts.get(collector.__name__, self.timeout)
+
+    def run_collector(self, collector):
+        with self.running_lock:
+            if collector.__name__ in self.running:
+                return self.timed_out(collector, "Collector still running from an earlier run, skipped:")
+            self.running.add(collector.__name__)
+        collector_data = dict()
+        set_deadline(time.monotonic() + self.get_timeout(collector))
+        try:
+            self.measure(collector_data, "collector.{}".format(collector.__name__), collector(self.local_config).collect, collector_data)
+        except CommandTimeoutException:
+            # A command that ran past the deadline is reported like a collector that's still running at it
+            return self.timed_out(collector)
+        finally:
+            set_deadline(None)
+            with self.running_lock:
+                self.running.discard(collector.__name__)
+        if self.counter_rates is not None:
+            self.counter_rates.apply(collector_data)
+        return collector_data
+
+    def measure(self, data, name, method, *args):
+        # Runs a collector or custom method, then adds how long it took, the CPU time used by this thread (not
+        # including commands), and the number of commands run and measurements collected, under systemmonitor.self
+        if not self.self_measurements:
+            method(*args)
+            return
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        commands = get_command_count()
+        count = len(data)
+        method(*args)
+        key = "systemmonitor.self.{}".format(name)
+        data["{}.measurements".format(key)] = Measurement(float(len(data) - count), 'raw')
+        data["{}.wall_time".format(key)] = Measurement(time.perf_counter() - started, 'raw', unit='s')
+        data["{}.cpu_time".format(key)] = Measurement(time.thread_time() - cpu_started, 'raw', unit='s')
+        data["{}.commands".format(key)] = Measurement(float(get_command_count() - commands), 'raw')
+        data["{}.timed_out".format(key)] = Measurement(False, 'bool')
+
+    def run_concurrently(self, collectors):
+        results = [None] * len(collectors)
+        errors = [None] * len(collectors)
+
+        def run(i, collector):
+            try:
+                results[i] = self.run_collector(collector)
+            except Exception as e:
+                errors[i] = e
+
+        # Daemon threads, so a collector that hangs can't stop the process exiting
+        started = time.monotonic()
+        threads = []
+        for i, collector in enumerate(collectors):
+            thread = threading.Thread(target=run, args=(i, collector), name=collector.__name__, daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        finished = []
+        timed_out = []
+        for i, thread in enumerate(threads):
+            remaining = started + self.get_timeout(collectors[i]) - time.monotonic()
+            thread.join(max(remaining, 0))
+            if thread.is_alive():
+                timed_out.append(self.timed_out(collectors[i]))
+            else:
+                finished.append(i)
+
+        for i in finished:
+            if errors[i] is not None:
+                raise errors[i]
+
+        return [results[i] for i in finished] + timed_out
+
+    def timed_out(self, collector, message="Collector timed out:"):
+        # Its data is left out of the sample
+        err(message, collector.__name__)
+        if not self.self_measurements:
+            return {}
+        return {
+            "systemmonitor.self.collector.{}.timed_out".format(collector.__name__): Measurement(True, 'bool'),
+        }
+
+
     ### Custom methods ###
 
     def data_file_date_modified(self, data, key, filename):
@@ -64,5 +208,10 @@ class Collector():
 
 class AbstractCollector():
 
+    def __init__(self, config=None):
+        if config is None:
+            config = {}
+        self.config = config
+
     def collect(self, data):
         raise Exception("Must be overridden")
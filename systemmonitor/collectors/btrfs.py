@@ -12,16 +12,10 @@ class BtrfsCollector(AbstractCollector):
 
     def collect(self, data):
         if check_installed("btrfs"):
-            disk_devices = self.get_disk_devices()
-            btrfs_filesystems = self.get_btrfs_devices(disk_devices)
+            btrfs_filesystems = self.get_btrfs_devices()
             self.data_btrfs_device_stats(data, btrfs_filesystems)
 
-    def get_disk_devices(self):
-        result = cmd('lsblk -pnJb -o NAME,FSAVAIL,FSUSE%')
-        devices = json.loads(result)
-        return devices['blockdevices']
-
-    def get_btrfs_devices(self, devices):
+    def get_btrfs_devices(self):
         try:
             filesystems = {}
             filesystem = None
@@ -1,24 +1,31 @@
 #!/usr/bin/python3
 
 from systemmonitor.collector import *
+from systemmonitor.devices import get_block_devices
+
+
+# smartctl exit status bits 0 and 1 mean the command failed, or the device is in standby,
+# and there is no data. Higher bits report problems with the disk, but the output is still valid.
+smartctl_failed_bits = 0b11
+# Exit status asked for when smartctl skips a disk in standby. Status 2 on its own also means the device couldn't
+# be opened, and a command line error (bit 0) can't happen together with opening the device, so 3 is only standby.
+smartctl_standby_status = 3
 
 
 class DiskCollector(AbstractCollector):
 
     def collect(self, data):
         # Disk Usage
-        disk_devices = self.get_disk_devices()
+        disk_devices = get_block_devices()
         for device in disk_devices:
             self.data_disk_usage(data, device)
 
         # Disk SMART Info
-        for device in disk_devices:
-            self.data_disk_smart(data, device['name'])
-
-    def get_disk_devices(self):
-        result = cmd('lsblk -pnJb -o NAME,FSAVAIL,FSUSE%')
-        devices = json.loads(result)
-        return devices['blockdevices']
+        if check_installed("smartctl"):
+            smart_cache = SmartCache(self.config.get('smart', {}))
+            for device in disk_devices:
+                self.data_disk_smart(data, device['name'], smart_cache)
+            smart_cache.save()
 
     def data_disk_usage(self, data, device):
         key = "hardware.disk.{0}".format(device['name'])
@@ -34,24 +41,92 @@ class DiskCollector(AbstractCollector):
                 if child['fsavail'] is not None:
                     data["{0}.available".format(child_key)] = Measurement(int(child['fsavail']), 'bytes')
 
-    def data_disk_smart(self, data, device_name):
-        if check_installed("smartctl"):
+    def data_disk_smart(self, data, device_name, smart_cache):
+        key = "hardware.disk.{0}.SMART".format(device_name)
+
+        # Only query the classes of data that have expired, in one smartctl call, without waking the disk
+        stale = smart_cache.stale(device_name)
+        if len(stale) > 0:
+            flags = ' '.join(['-H' if c == 'health' else '-A' for c in stale])
             try:
-                key = "hardware.disk.{0}.SMART".format(device_name)
-
-                status = json.loads(cmd("sudo smartctl -Hj {0}".format(device_name)))
-                data["{0}.passed".format(key)] = Measurement(status['smart_status']['passed'], 'bool')
-
-                details = json.loads(cmd("sudo smartctl -Aj {0}".format(device_name)))
-                if details['device']['type'] == 'sat':
-                    for attribute in details['ata_smart_attributes']['table']:
-                        data["{0}.attributes.{1}".format(key, attribute['name'])] = Measurement(float(attribute['raw']['value']), 'raw')
-                elif details['device']['type'] == 'nvme':
-                    for attribute, value in details['nvme_smart_health_information_log'].items():
-                        if type(value) == list:
-                            for i, v in enumerate(value):
-                                data["{0}.attributes.{1}.{2}".format(key, attribute, i)] = Measurement(float(v), 'raw')
-                        else:
-                            data["{0}.attributes.{1}".format(key, attribute)] = Measurement(float(value), 'raw')
+                details = json.loads(cmd("sudo smartctl {0} -j -n standby,{1} {2}".format(flags, smartctl_standby_status, device_name)))
             except CommandException as e:
-                err("SMART command failed:", e.error)
+                details = None
+                if e.code == smartctl_standby_status:
+                    # Device is in standby - use cached values, if any
+                    pass
+                elif e.code is not None and e.code & smartctl_failed_bits == 0 and e.output:
+                    details = json.loads(e.output)
+                else:
+                    err("SMART command failed:", e.error)
+            if details is not None:
+                smart_cache.update(device_name, stale, self.parse_smart(details))
+
+        for suffix, value in smart_cache.get(device_name).items():
+            data["{0}.{1}".format(key, suffix)] = Measurement(value, 'bool' if suffix == 'passed' else 'raw')
+
+    def parse_smart(self, details):
+        measurements = {}
+        if 'smart_status' in details:
+            measurements['health'] = {'passed': details['smart_status']['passed']}
+        attributes = {}
+        if details['device']['type'] == 'sat' and 'ata_smart_attributes' in details:
+            for attribute in details['ata_smart_attributes']['table']:
+                attributes["attributes.{0}".format(attribute['name'])] = float(attribute['raw']['value'])
+        elif details['device']['type'] == 'nvme' and 'nvme_smart_health_information_log' in details:
+            for attribute, value in details['nvme_smart_health_information_log'].items():
+                if type(value) == list:
+                    for i, v in enumerate(value):
+                        attributes["attributes.{0}.{1}".format(attribute, i)] = float(v)
+                else:
+                    attributes["attributes.{0}".format(attribute)] = float(value)
+        if len(attributes) > 0:
+            measurements['attributes'] = attributes
+        return measurements
+
+
+class SmartCache():
+
+    default_ttl = {
+        'health': 3600,
+        'attributes': 3600,
+    }
+
+    def __init__(self, config):
+        self.filename = config.get('cache', os.path.join(get_cache_dir(), 'smart.json'))
+        self.ttl = dict(self.default_ttl)
+        self.ttl.update(config.get('ttl', {}))
+        # Cached values older than this aren't used, so a disk that can't be read stops reporting its last values
+        self.max_age = config.get('max_age', 86400)
+        self.now = time.time()
+        self.devices = read_json_file(self.filename, {})
+        self.changed = False
+
+    def stale(self, device_name):
+        device = self.devices.get(device_name, {})
+        return [c for c in ('health', 'attributes')
+            if c not in device or device[c]['taken'] + self.ttl[c] <= self.now]
+
+    def update(self, device_name, classes, measurements):
+        device = self.devices.setdefault(device_name, {})
+        for c in classes:
+            device[c] = {
+                'taken': self.now,
+                'measurements': measurements.get(c, {}),
+            }
+        self.changed = True
+
+    def get(self, device_name):
+        values = {}
+        for c in ('health', 'attributes'):
+            cached = self.devices.get(device_name, {}).get(c)
+            if cached is not None and cached['taken'] + self.max_age > self.now:
+                values.update(cached['measurements'])
+        return values
+
+    def save(self):
+        if self.changed:
+            try:
+                write_json_file(self.filename, self.devices)
+            except OSError as e:
+                err("Could not write SMART cache:", e)
@@ -3,14 +3,38 @@
 from systemmonitor.collector import *
 
 
+meminfo_regex = re.compile(r'^(\S+):\s+(\d+)(?:\s+kB)?\s*$')
+
+
 class MemoryCollector(AbstractCollector):
 
     def collect(self, data):
-        result = cmd('free -wb | head -n2 | tail -n+2')
-        line_regex = re.compile('^Mem:\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s*$')
-        line_match = line_regex.match(result)
-        if line_match:
-            field_names = ('total', 'used', 'free', 'shared', 'buffers', 'cache', 'available')
-            total = int(line_match.group(1))
-            for i in range(1, len(field_names)):
-                data["hardware.memory.{0}".format(field_names[i])] = Measurement(int(line_match.group(i + 1)) / total * 100, '%')
+        meminfo = self.read_meminfo()
+        if 'MemTotal' not in meminfo:
+            return
+
+        # Same fields as "free -w" reports
+        total = meminfo['MemTotal']
+        free = meminfo['MemFree']
+        buffers = meminfo.get('Buffers', 0)
+        cache = meminfo.get('Cached', 0) + meminfo.get('SReclaimable', 0)
+        available = meminfo.get('MemAvailable', free)
+        fields = (
+            ('used', total - available),
+            ('free', free),
+            ('shared', meminfo.get('Shmem', 0)),
+            ('buffers', buffers),
+            ('cache', cache),
+            ('available', available),
+        )
+        for field_name, value in fields:
+            data["hardware.memory.{0}".format(field_name)] = Measurement(value / total * 100, '%')
+
+    def read_meminfo(self):
+        meminfo = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                line_match = meminfo_regex.match(line)
+                if line_match:
+                    meminfo[line_match.group(1)] = int(line_match.group(2)) * 1024
+        return meminfo
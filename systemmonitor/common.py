@@ -1,18 +1,51 @@
 #!/usr/bin/python3
 
+from array import array
+from collections.abc import Mapping
 from datetime import *
 import json
+import os
 import os.path
+import re
+import shutil
+import signal
 import subprocess
 import sys
-import yaml
+import threading
+import time
 
 
 datetime_format = '%Y-%m-%d %H:%M:%S'
 
+duration_regex = re.compile(r'^(\d+(?:\.\d+)?)\s*([smhdwy])$')
+duration_units = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+    'w': 604800,
+    'y': 31536000,
+}
+
+# Per-thread state, so each collector thread can have its own deadline
+_thread_state = threading.local()
+
+# Parsed config files, by filename, with the modification time and size they were parsed at
+_config_cache = {}
+
+# Array type codes used to store history of each type of measurement - other types are stored in lists
+history_typecodes = {
+    '%': 'd',
+    '%s': 'd',
+    'raw': 'd',
+    'bytes': 'q',
+}
+
 
 class Measurement():
 
+    __slots__ = ('value', 'type', 'unit', 'values', 'latest')
+
     def __init__(self, value, value_type, unit=None, values=None, latest=None):
         self.value = value
         self.type = value_type
@@ -34,39 +67,90 @@ class Measurement():
         return res
 
 
+class History(Mapping):
+
+    # Values of a measurement over time, read-only and ordered by time, stored as columns - positions in a
+    # list of timestamps shared by all measurements from the same fetch, and a typed array of values.
+    # Behaves as a dict of timestamp to value.
+
+    __slots__ = ('timestamps', 'positions', 'data', 'lookup')
+
+    def __init__(self, timestamps, value_type=None):
+        self.timestamps = timestamps
+        self.positions = array('I')
+        if value_type in history_typecodes:
+            self.data = array(history_typecodes[value_type])
+        else:
+            self.data = []
+        self.lookup = None
+
+    def append(self, position, value):
+        # Values that don't fit the array (e.g. None) turn it into a list
+        try:
+            self.data.append(value)
+        except TypeError:
+            self.data = list(self.data)
+            self.data.append(value)
+        self.positions.append(position)
+        self.lookup = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        timestamps = self.timestamps
+        return (timestamps[p] for p in self.positions)
+
+    def __getitem__(self, taken):
+        if self.lookup is None:
+            self.lookup = dict([(self.timestamps[p], i) for i, p in enumerate(self.positions)])
+        return self.data[self.lookup[taken]]
+
+    def times(self):
+        return list(self)
+
+    def values(self):
+        return self.data
+
+    def items(self):
+        return zip(self, self.data)
+
+    def numpy(self):
+        import numpy
+        if isinstance(self.data, array):
+            return numpy.frombuffer(self.data, dtype=numpy.float64 if self.data.typecode == 'd' else numpy.int64)
+        return numpy.array(self.data)
+
+
 class CommandException(Exception):
 
-    def __init__(self, code, error):
+    def __init__(self, code, error, output=None):
         self.code = code
         self.error = error
+        self.output = output
         super().__init__(self, "Command returned code {} - {}".format(code, error))
 
 
-class DateTimeEncoder(json.JSONEncoder):
+# Not a CommandException, so collectors that carry on after a failed command still stop at the deadline
+class CommandTimeoutException(Exception):
+
+    def __init__(self, command, timeout):
+        self.command = command
+        self.timeout = timeout
+        super().__init__(self, "Command timed out after {:.1f}s - {}".format(timeout, command))
 
-    def _preprocess_date(self, obj):
-        if isinstance(obj, (date, datetime, timedelta)):
-            return str(obj)
-        if isinstance(obj, Measurement):
-            return obj.json()
-        elif isinstance(obj, dict):
-            return {self._preprocess_date(k): self._preprocess_date(v) for k,v in obj.items()}
-        elif isinstance(obj, list):
-            return [self._preprocess_date(i) for i in obj]
-        return obj
+
+class DateTimeEncoder(json.JSONEncoder):
 
     def default(self, obj):
-        if isinstance(obj, (date, datetime, timedelta)):
-            return str(obj)
-        if isinstance(obj, Measurement):
-            return obj.json()
-        return super().default(obj)
+        return json_default(obj)
 
-    def iterencode(self, obj, _one_shot=True):
-        return super().iterencode(self._preprocess_date(obj), _one_shot)
+    def iterencode(self, obj, _one_shot=False):
+        return super().iterencode(json_date_keys(obj), _one_shot)
 
 
-def get_config(host):
+def get_all_config():
+    # Config for every host, from the first config file found
     config_files = [
         '~/.config/systemmonitor.yml',
         '/usr/local/etc/systemmonitor.yml',
@@ -75,27 +159,176 @@ def get_config(host):
     for config_file in config_files:
         config_file = os.path.expanduser(config_file)
         if os.path.exists(config_file):
-            with open(config_file, 'r') as fh:
-                config = yaml.load(fh, Loader=yaml.CLoader)
-            if host in config:
-                return config[host]
-            return {}
+            stat = os.stat(config_file)
+            version = [config_file, stat.st_mtime_ns, stat.st_size]
+            if config_file not in _config_cache or _config_cache[config_file][0] != version:
+                _config_cache[config_file] = (version, load_config_file(config_file))
+            return _config_cache[config_file][1]
     return {}
 
-def cmd(command):
-    result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout = result.stdout.decode('utf-8').rstrip("\n")
-    stderr = result.stderr.decode('utf-8').rstrip("\n")
-    if result.returncode != 0:
-        raise CommandException(result.returncode, stderr)
+def load_config_file(config_file):
+    import yaml
+    with open(config_file, 'r') as fh:
+        return yaml.load(fh, Loader=yaml.CLoader) or {}
+
+def get_config(host):
+    config = get_all_config()
+    if host in config:
+        return config[host]
+    return {}
+
+def set_deadline(deadline):
+    # Commands run by this thread will be killed if still running at the deadline (a time.monotonic() value)
+    _thread_state.deadline = deadline
+
+def cmd(command, timeout=None):
+    deadline = getattr(_thread_state, 'deadline', None)
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if timeout is None or remaining < timeout:
+            timeout = remaining
+        if timeout <= 0:
+            raise CommandTimeoutException(command, 0)
+    _thread_state.commands = get_command_count() + 1
+
+    # Run in its own session so the whole process group can be killed on timeout
+    with subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True) as process:
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                process.kill()
+            process.communicate()
+            raise CommandTimeoutException(command, timeout)
+
+    stdout = stdout.decode('utf-8').rstrip("\n")
+    stderr = stderr.decode('utf-8').rstrip("\n")
+    if process.returncode != 0:
+        raise CommandException(process.returncode, stderr, stdout)
     return stdout
 
+def get_command_count():
+    # Number of commands run by this thread
+    return getattr(_thread_state, 'commands', 0)
+
 def check_installed(command):
+    return shutil.which(command) is not None
+
+def parse_duration(duration):
+    # Durations are a number of seconds, or a string such as '30s', '10m', '6h', '30d', '2w', '1y'
+    if isinstance(duration, timedelta):
+        return duration
+    if isinstance(duration, (int, float)):
+        return timedelta(seconds=duration)
+    duration_match = duration_regex.match(duration.strip())
+    if not duration_match:
+        raise Exception("Invalid duration: {}".format(duration))
+    return timedelta(seconds=float(duration_match.group(1)) * duration_units[duration_match.group(2)])
+
+def parse_time(time_string):
+    # Times are either absolute ('2021-01-31 12:00:00' or '2021-01-31'), or a duration before now ('6h')
+    if duration_regex.match(time_string.strip()):
+        return datetime.now().replace(microsecond=0) - parse_duration(time_string)
+    for time_format in (datetime_format, '%Y-%m-%d'):
+        try:
+            return datetime.strptime(time_string.strip(), time_format)
+        except ValueError:
+            pass
+    raise Exception("Invalid time: {}".format(time_string))
+
+def pattern_regex(pattern):
+    # The same patterns as measurement filters - * is a wildcard, otherwise a pattern matches that measurement
+    # and everything under it
+    if '*' in pattern:
+        return re.compile('^{}$'.format('.*'.join([re.escape(p) for p in pattern.split('*')])))
+    return re.compile(r'^{}(\..*)?$'.format(re.escape(pattern)))
+
+def get_boot_id():
+    # Changes every time the host boots, so counters that started again from zero can be told apart
     try:
-        cmd("command -v {}".format(command))
-    except CommandException as e:
-        return False
-    return True
+        with open('/proc/sys/kernel/random/boot_id') as fh:
+            return fh.read().strip()
+    except OSError:
+        return None
+
+def get_cache_dir():
+    # Root (the service) caches under /var/cache, anyone else under their home directory
+    if os.geteuid() == 0:
+        cache_dir = '/var/cache/systemmonitor'
+    else:
+        cache_dir = os.path.expanduser('~/.cache/systemmonitor')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def read_json_file(filename, default=None):
+    try:
+        with open(filename, 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return default
+
+def write_json_file(filename, data):
+    # Write to a temporary file and rename it into place, so readers never see a partial file
+    temp_filename = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+    with open(temp_filename, 'w') as fh:
+        json.dump(data, fh)
+    os.replace(temp_filename, filename)
+
+def json_default(obj):
+    if isinstance(obj, (date, datetime, timedelta)):
+        return str(obj)
+    if isinstance(obj, Measurement):
+        return obj.json()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+def json_date_keys(obj):
+    # Dates used as dict keys are written as strings, as date values are. Only dicts and lists that contain one
+    # are copied, and Measurements are left to json_default, so the rest of the data isn't copied.
+    if isinstance(obj, dict):
+        converted = dict([(str(k) if isinstance(k, (date, datetime, timedelta)) else k, json_date_keys(v)) for k, v in obj.items()])
+        if all([k1 is k2 and v1 is v2 for (k1, v1), (k2, v2) in zip(obj.items(), converted.items())]) and len(obj) == len(converted):
+            return obj
+        return converted
+    if isinstance(obj, list):
+        converted = [json_date_keys(i) for i in obj]
+        if all([i1 is i2 for i1, i2 in zip(obj, converted)]):
+            return obj
+        return converted
+    return obj
+
+def write_json(data, fh=None):
+    # Pretty-printed, written as it is encoded rather than built up as one string first
+    if fh is None:
+        fh = sys.stdout
+    json.dump(data, fh, cls=DateTimeEncoder, sort_keys=True, indent=4)
+    fh.write("\n")
+    fh.flush()
+
+def write_ndjson(records, fh=None):
+    # One compact JSON object per line, written as each record is produced. Uses orjson if it's installed.
+    if fh is None:
+        fh = sys.stdout
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
+    # Anything already written as text has to go out before writing bytes underneath it
+    fh.flush()
+    for record in records:
+        if orjson is not None:
+            fh.buffer.write(orjson.dumps(record, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE))
+        else:
+            fh.write(json.dumps(record, default=json_default, sort_keys=True, separators=(',', ':')) + "\n")
+    fh.flush()
+
+def measurement_records(data):
+    # Flat (measurement, Measurement) pairs as NDJSON records
+    for key, measurement in data:
+        record = measurement.json()
+        record['measurement'] = key
+        yield record
 
 def out(*messages):
     print(' '.join([str(m) for m in messages]), flush=True)
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+from systemmonitor.common import *
+
+import threading
+import time
+
+
+class CounterRates():
+
+    # Works out the rate per second of each counter when it's collected, from its value at the last collection,
+    # kept in a state file. Counters start again from zero when the host boots, so the state is only used if it
+    # was saved since the current boot, and a counter that has gone down has no rate until the next collection.
+
+    def __init__(self, config):
+        if not isinstance(config, dict):
+            config = {}
+        self.filename = config.get('file', os.path.join(get_cache_dir(), 'counters.json'))
+        # Rates are added alongside the counters, as <counter>_rate, or replace them
+        self.mode = config.get('mode', 'alongside')
+        if self.mode not in ('alongside', 'instead'):
+            raise Exception("Invalid counter rates mode: {}".format(self.mode))
+        # '%s' measurements are always counters, raw ones only if they match one of these patterns
+        self.patterns = [pattern_regex(pattern) for pattern in config.get('counters', default_raw_counters)]
+        # Counters that haven't been collected for this long are forgotten
+        self.max_age = parse_duration(config.get('max_age', '7d')).total_seconds()
+        self.lock = threading.Lock()
+        self.boot_id = get_boot_id()
+        state = read_json_file(self.filename, {})
+        self.counters = {}
+        if isinstance(state, dict) and state.get('boot_id') == self.boot_id:
+            self.counters = state.get('counters', {})
+
+    def is_counter(self, key, measurement):
+        if measurement.type == '%s':
+            return True
+        return measurement.type == 'raw' and any([pattern.match(key) for pattern in self.patterns])
+
+    def apply(self, data, now=None):
+        # Adds the rate of each counter in data since it was last collected. The monotonic clock counts from boot,
+        # and stops when the host is suspended, as CPU time does.
+        if now is None:
+            now = time.monotonic()
+        rates = {}
+        with self.lock:
+            for key, m in list(data.items()):
+                if m.value is None or not self.is_counter(key, m):
+                    continue
+                previous = self.counters.get(key)
+                self.counters[key] = [now, m.value]
+                if self.mode == 'instead':
+                    del data[key]
+                if previous is None:
+                    continue
+                (previous_time, previous_value) = previous
+                seconds = now - previous_time
+                if seconds <= 0 or m.value < previous_value:
+                    continue
+                rate = (m.value - previous_value) / seconds
+                # A sibling of the counter, as the counter is a leaf and can't have children
+                rate_key = key if self.mode == 'instead' else "{}_rate".format(key)
+                # '%s' counters are in percent seconds, so their rates are percentages
+                if m.type == '%s':
+                    rates[rate_key] = Measurement(rate, '%')
+                else:
+                    rates[rate_key] = Measurement(rate, 'raw', unit=("{}/s".format(m.unit) if m.unit is not None else '/s'))
+        data.update(rates)
+
+    def save(self):
+        now = time.monotonic()
+        with self.lock:
+            self.counters = dict([(key, value) for key, value in self.counters.items() if now - value[0] <= self.max_age])
+            state = {
+                'boot_id': self.boot_id,
+                'counters': dict(self.counters),
+            }
+        try:
+            write_json_file(self.filename, state)
+        except OSError as e:
+            err("Could not write counter state:", e)
+
+
+# Raw measurements that count up, rather than measure a level. SMART counters aren't included, as they come from
+# the SMART cache, so only change when it expires.
+default_raw_counters = [
+    'btrfs.filesystem.*.device.*.stats',
+]
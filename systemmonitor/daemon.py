@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+from systemmonitor.common import *
+from systemmonitor.collector import Collector
+from systemmonitor.database import Database
+from systemmonitor.spool import Spool
+
+from datetime import *
+import signal
+import threading
+import time
+
+
+class Daemon():
+
+    def __init__(self):
+        # Everything is loaded once, and the database connection is kept open between pushes
+        self.collector = Collector()
+        self.database = Database('localhost', persistent=True)
+        self.stopping = threading.Event()
+
+        daemon_config = self.collector.local_config.get('daemon', {})
+        self.interval = parse_duration(daemon_config.get('interval', 600)).total_seconds()
+        self.intervals = dict([(name, parse_duration(interval).total_seconds())
+            for name, interval in daemon_config.get('intervals', {}).items()])
+
+        # If a spool is configured, samples are written to it, and pushed to the database by a separate thread
+        self.spool = None
+        if 'spool' in self.collector.local_config:
+            self.spool = Spool(self.collector.local_config['spool'])
+            self.replay_interval = parse_duration(daemon_config.get('replay_interval', 60)).total_seconds()
+
+        # Custom methods are scheduled together, under the name 'custom'
+        self.schedule = dict([(collector.__name__, collector) for collector in self.collector.collectors])
+        if 'custom' in self.collector.local_config:
+            self.schedule['custom'] = None
+        # Each run is on its own thread, so a slow collector doesn't hold up the next runs
+        self.threads = []
+        self.custom_thread = None
+        self.output_lock = threading.Lock()
+
+    def get_interval(self, name):
+        return self.intervals.get(name, self.interval)
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        replay_thread = None
+        if self.spool is not None:
+            replay_thread = threading.Thread(target=self.replay, name='replay')
+            replay_thread.start()
+
+        now = time.monotonic()
+        next_runs = dict([(name, now) for name in self.schedule.keys()])
+
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            due = [name for name, next_run in next_runs.items() if next_run <= now]
+            if len(due) > 0:
+                self.start_run(due)
+                for name in due:
+                    # Skip any runs that were missed, rather than running them all at once
+                    interval = self.get_interval(name)
+                    while next_runs[name] <= now:
+                        next_runs[name] += interval
+            self.stopping.wait(max(min(next_runs.values()) - time.monotonic(), 0))
+
+        # Collectors are stopped at their time limits, so don't wait longer than the longest
+        timeout = max([self.collector.timeout] + list(self.collector.timeouts.values()))
+        for thread in self.threads:
+            thread.join(timeout)
+        if replay_thread is not None:
+            replay_thread.join()
+            self.spool.close()
+        elif self.database.push_connection is not None:
+            self.database.disconnect_push()
+
+    def replay(self):
+        while not self.stopping.is_set():
+            try:
+                self.spool.replay(self.database)
+            except Exception as e:
+                err("Failed to replay spool:", e)
+            self.stopping.wait(self.replay_interval)
+        if self.database.push_connection is not None:
+            self.database.disconnect_push()
+
+    def start_run(self, names):
+        # Collectors still running from an earlier run are skipped by the collector, and custom methods here
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        if 'custom' in names and self.custom_thread is not None and self.custom_thread.is_alive():
+            err("Custom methods still running from an earlier run, skipped")
+            names = [name for name in names if name != 'custom']
+            if len(names) == 0:
+                return
+        thread = threading.Thread(target=self.run_once, args=(names,), name='run', daemon=True)
+        if 'custom' in names:
+            self.custom_thread = thread
+        self.threads.append(thread)
+        thread.start()
+
+    def run_once(self, names):
+        taken = datetime.now().strftime(datetime_format)
+        collectors = [self.schedule[name] for name in names if name != 'custom']
+        try:
+            data = self.collector.collect(structured_data=False, collectors=collectors, custom=('custom' in names))
+        except Exception as e:
+            err("Failed to collect data:", e)
+            return
+        if len(data) == 0:
+            return
+        # Runs can finish at the same time, and the spool and database connection are shared
+        with self.output_lock:
+            if self.spool is not None:
+                self.spool.append(data, taken)
+                return
+            try:
+                self.database.push(data, taken)
+            except Exception as e:
+                err("Failed to push data:", e)
@@ -1,25 +1,63 @@
 #!/usr/bin/python3
 
 from systemmonitor.common import *
+from systemmonitor.backends import backends, get_backend
 
 from datetime import *
-import mariadb
 import sys
+import threading
+import time
 
 
 class Database():
 
-    def __init__(self, host):
+    def __init__(self, host, persistent=False, pooled=False):
         # Load config
+        self.host = host
         host_config = get_config(host)
 
         if 'db' not in host_config:
             raise Exception("No database config found")
 
-        self.db_host = host_config['db']['host']
-        self.db_schema = host_config['db']['schema']
+        # Where the data is stored - a MariaDB server by default, or a local SQLite file
+        self.backend = get_backend(host_config['db'])
+        self.layout = host_config['db'].get('layout', self.backend.default_layout)
+        if self.layout not in layouts:
+            raise Exception("Invalid database layout: {}".format(self.layout))
+        self.push_batch_size = host_config['db'].get('push_batch_size', 1000)
+        self.rollup_on_push = host_config['db'].get('rollup_on_push', False)
+        self.retention = host_config.get('retention', {})
+        self.push_stats = None
+        self.fetch_stats = None
+        # Timings of the last push and fetch are pushed with the next sample, under systemmonitor.self
+        self.self_measurements = host_config['db'].get('self_measurements', True)
+        # Measurements that rarely change can be pushed only when they change, or when the heartbeat has passed
+        self.dedup = None
+        if host_config['db'].get('dedup'):
+            from systemmonitor.dedup import Dedup
+            self.dedup = Dedup(host, host_config['db']['dedup'])
+        # Fetched samples can be kept in a local cache, so later fetches only read the samples newer than it has
+        self.fetch_cache = None
+        if host_config['db'].get('fetch_cache') and self.dedup is not None:
+            err("fetch_cache isn't used for hosts with dedup:", host)
+        elif host_config['db'].get('fetch_cache'):
+            from systemmonitor.fetchcache import FetchCache
+            self.fetch_cache = FetchCache(host, host_config['db']['fetch_cache'])
+        # A persistent object keeps its push connection open between pushes
+        self.persistent = persistent
+        self.push_connection = None
+        # A pooled object gets its read connection from the read pool, and gives it back after each fetch
+        self.pooled = pooled
+        self.measurement_ids = {}
         self.db_read = False
         self.db_push = False
+        self.db_admin = False
+
+        if not self.backend.needs_users:
+            self.db_read = self.db_push = self.db_admin = True
+            self.db_read_user = self.db_read_pass = None
+            self.db_push_user = self.db_push_pass = None
+            self.db_admin_user = self.db_admin_pass = None
 
         if 'read' in host_config['db']:
             self.db_read = True
@@ -31,130 +69,983 @@ class Database():
             self.db_push_user = host_config['db']['push']['user']
             self.db_push_pass = host_config['db']['push']['pass']
 
-    def fetch(self, samples=None, structured_data=True):
-        self.connect_read()
-        cur = self.read_connection.cursor()
+        if 'admin' in host_config['db']:
+            self.db_admin = True
+            self.db_admin_user = host_config['db']['admin']['user']
+            self.db_admin_pass = host_config['db']['admin']['pass']
+
+        # Rollups are updated with the admin connection
+        if self.rollup_on_push and not self.db_admin:
+            err("rollup_on_push needs admin DB config, rollups won't be updated on push")
+            self.rollup_on_push = False
+
+    def fetch(self, samples=None, structured_data=True, start=None, end=None, measurements=None, resolution=None, aggregate='avg'):
+        # Fetch either the last number of samples, or all samples from the start time, up to the end time if given.
+        # Measurements can be limited to a pattern (or list of patterns) - see measurement_filter.
+        # If a resolution is given, samples are read from the coarsest rollup that is at least that fine.
+        if samples is not None and start is not None:
+            raise Exception("Specify either number of samples or start time, not both")
+        if samples is None and start is None:
+            raise Exception("Need to specify number of samples or start time")
+        if isinstance(start, str):
+            start = parse_time(start)
+        if isinstance(end, str):
+            end = parse_time(end)
+        rollup = None
+        if resolution is not None:
+            rollup = self.choose_rollup(resolution)
+
+        started = time.perf_counter()
+        if rollup is None and self.fetch_cache is not None:
+            # The cache is only open while fetching, so a Database kept for each host doesn't hold it open
+            try:
+                (cur, scope) = self.update_fetch_cache(samples=samples, start=start, end=end, measurements=measurements)
+                data = self.query(cur, samples=samples, start=start, end=end, measurements=measurements, layout=self.fetch_cache.layout(scope))
+                self.fetch_cache.evict(scope)
+            finally:
+                self.fetch_cache.close()
+        else:
+            self.connect_read()
+            cur = self.read_connection.cursor()
+            try:
+                if rollup is not None:
+                    data = self.query_rollups(cur, rollup, aggregate, samples=samples, start=start, end=end, measurements=measurements)
+                else:
+                    data = self.query(cur, samples=samples, start=start, end=end, measurements=measurements)
+            except self.backend.Error as e:
+                self.read_connection.close()
+                raise e
+            self.disconnect_read()
+        self.fetch_stats = {
+            'measurements': len(data),
+            'seconds': time.perf_counter() - started,
+        }
+
+        if structured_data:
+            return structure_data(data);
+        return data
+
+    def iter_fetch(self, samples=None, start=None, end=None, measurements=None, resolution=None, aggregate='avg'):
+        # Like fetch, but yields (measurement, Measurement) pairs one at a time, in measurement order,
+        # so only one measurement's history is held in memory at once
+        if resolution is not None and self.choose_rollup(resolution) is not None:
+            data = self.fetch(samples=samples, structured_data=False, start=start, end=end, measurements=measurements, resolution=resolution, aggregate=aggregate)
+            for measurement in sorted(data.keys()):
+                yield (measurement, data[measurement])
+            return
+        if samples is not None and start is not None:
+            raise Exception("Specify either number of samples or start time, not both")
+        if samples is None and start is None:
+            raise Exception("Need to specify number of samples or start time")
+        if isinstance(start, str):
+            start = parse_time(start)
+        if isinstance(end, str):
+            end = parse_time(end)
+
+        started = time.perf_counter()
+        count = 0
+        if self.fetch_cache is not None:
+            # Also closed if the caller stops early
+            try:
+                (cur, scope) = self.update_fetch_cache(samples=samples, start=start, end=end, measurements=measurements)
+                for pair in self.group_rows(self.query_rows(cur, samples=samples, start=start, end=end, measurements=measurements, by_measurement=True, layout=self.fetch_cache.layout(scope))):
+                    count += 1
+                    yield pair
+                self.fetch_cache.evict(scope)
+            finally:
+                self.fetch_cache.close()
+        else:
+            self.connect_read()
+            try:
+                cur = self.read_connection.cursor()
+                for pair in self.group_rows(self.query_rows(cur, samples=samples, start=start, end=end, measurements=measurements, by_measurement=True)):
+                    count += 1
+                    yield pair
+            except self.backend.Error as e:
+                self.read_connection.close()
+                raise e
+            self.disconnect_read()
+        # Includes the time taken by the caller to use each measurement
+        self.fetch_stats = {
+            'measurements': count,
+            'seconds': time.perf_counter() - started,
+        }
+
+    def group_rows(self, rows):
+        # Yields a (measurement, Measurement) pair for each measurement, from rows in measurement then time order
+        current = None
+        data = {}
+        timestamps = []
+        for (taken, measurement, value_type, value, unit) in rows:
+            if measurement != current:
+                if current is not None:
+                    yield (current, data.pop(current))
+                current = measurement
+                timestamps = []
+            self.add_sample(data, timestamps, measurement, value_type, unit, taken, value)
+        if current is not None:
+            yield (current, data.pop(current))
+
+    def query(self, cur, samples=None, start=None, end=None, measurements=None, layout=None):
+        if self.dedup is not None:
+            # Repeated values are filled in a measurement at a time, so each measurement has its own sample times
+            return dict(self.group_rows(self.query_rows(cur, samples=samples, start=start, end=end, measurements=measurements, by_measurement=True, layout=layout)))
+        data = {}
+        # Sample times shared by the history of all measurements
+        timestamps = []
+        for (taken, measurement, value_type, value, unit) in self.query_rows(cur, samples=samples, start=start, end=end, measurements=measurements, layout=layout):
+            self.add_sample(data, timestamps, measurement, value_type, unit, taken, value)
+        return data
+
+    def query_rows(self, cur, samples=None, start=None, end=None, measurements=None, by_measurement=False, layout=None):
+        # Yields (taken, measurement, value_type, value, unit) for each sample, in time order, or by measurement
+        # then time order. '%s' counters are turned into rates, so their first sample isn't included.
+        # Rows are read from the database's layout, unless another is given, such as the fetch cache's.
+        # With dedup, the last value of deduplicated measurements is repeated at each time its collector ran.
+        if layout is None:
+            layout = layouts[self.layout]
+        if self.dedup is not None and not by_measurement:
+            raise Exception("Deduplicated measurements can only be read by measurement")
+        where, params = self.measurement_filter(measurements)
+        end_sql = ''
+        end_params = []
+        if end is not None:
+            end_sql = " AND taken <= ?"
+            end_params = [end]
+        where_sql = ''.join([" AND {}".format(w) for w in where]) + end_sql
+        params += end_params
+
+        # With dedup, sample times are those of the collectors of the measurements, as deduplicated ones aren't
+        # pushed every time
+        times_sql = where_sql
+        times_params = params
+        if self.dedup is not None:
+            groups = self.get_dedup_groups(cur, layout, measurements)
+            group_where = ["1 = 0"]
+            group_params = []
+            if len(groups) > 0:
+                (group_where, group_params) = self.measurement_filter(groups)
+            times_sql = ''.join([" AND {}".format(w) for w in group_where]) + end_sql
+            times_params = group_params + end_params
 
         earliest = None
         second_earliest = None
         if samples is not None:
             if samples < 1:
                 raise Exception("Number of samples needs to be at least one")
-            cur.execute("SELECT distinct(taken) FROM measurements ORDER BY taken desc LIMIT ?", (samples + 1,))
-            count = 0
-            for (date,) in cur:
-                second_earliest = earliest
-                earliest = date
-                count += 1
-            if count <= samples:
+            cur.execute("SELECT distinct(taken) {} WHERE 1 = 1{} ORDER BY taken desc LIMIT ?".format(layout['from'], times_sql), times_params + [samples + 1])
+            takens = [date for (date,) in cur]
+            if len(takens) < samples:
                 raise Exception("There aren't enough samples in the database")
+            # The sample before the first is needed for the rates of '%s' counters at the first sample, if there is one.
+            # Rates worked out when collected don't need it.
+            second_earliest = takens[samples - 1]
+            if len(takens) > samples:
+                earliest = takens[samples]
         else:
-            raise Exception("Need to specify number of samples")
+            # The sample before the start time is needed to work out rates of '%s' counters at the start time
+            second_earliest = start
+            cur.execute("SELECT MAX(taken) {} WHERE taken < ?{}".format(layout['from'], where_sql), [start] + params)
+            (earliest,) = cur.fetchone()
 
-        if second_earliest is None:
-            raise Exception("Not enough samples - there needs to be at least two in the database")
+        if self.dedup is None:
+            cur.execute("{} {} WHERE (taken >= ? OR (taken = ? AND value_type = '%s')){} ORDER BY {}".format(layout['select'], layout['from'], where_sql,
+                'measurement, taken' if by_measurement else 'taken'), [second_earliest, earliest] + params)
+            yield from self.rate_rows(cur)
+            return
 
-        cur.execute("SELECT taken, measurement, value_type, value, unit FROM measurements WHERE taken >= ? OR (taken = ? AND value_type = '%s') ORDER BY taken",
-            (second_earliest, earliest,))
+        # The times each collector ran
+        group_times = {}
+        for group in groups:
+            (group_where, group_params) = self.measurement_filter(group)
+            cur.execute("SELECT distinct(taken) {} WHERE taken >= ? AND {}{} ORDER BY taken".format(layout['from'], group_where[0], end_sql), [second_earliest] + group_params + end_params)
+            group_times[group] = [date for (date,) in cur]
 
-        data = {}
-        raw = {}
+        # The last values of deduplicated measurements pushed before the first sample time, within the heartbeat
+        types = sorted(self.dedup.types)
+        cur.execute("{} {} WHERE (taken >= ? OR (taken = ? AND value_type = '%s') OR (taken > ? AND value_type IN ({}))){} ORDER BY measurement, taken".format(
+            layout['select'], layout['from'], ', '.join(['?'] * len(types)), where_sql), [second_earliest, earliest, second_earliest - self.dedup.heartbeat] + types + params)
+        yield from self.fill_rows(self.rate_rows(cur), group_times, second_earliest)
+
+    def get_dedup_groups(self, cur, layout, measurements):
+        # The collectors' groups of the measurements matching the patterns
+        where, params = self.measurement_filter(measurements)
+        where_sql = ''.join([" AND {}".format(w) for w in where])
+        cur.execute("SELECT DISTINCT measurement {} WHERE 1 = 1{}".format(layout['names'], where_sql), params)
+        return sorted(set([self.dedup.group(measurement) for (measurement,) in cur]))
 
-        for (taken, measurement, value_type, value, unit) in cur:
+    def rate_rows(self, cur):
+        # Decodes each row read by query_rows, and turns '%s' counters into rates.
+        # Last raw counter value and time for each '%s' measurement, to compute rates from
+        previous = {}
+
+        for (taken, measurement, value_type, value, value_text, unit) in cur:
 
             add_data = True
 
-            if value_type in ('%', 'raw'):
-                value = float(value)
+            if self.layout == 'normalized':
+                value = self.decode_value(value_type, value, value_text)
+            else:
+                value = self.parse_value(value_type, value)
 
-            elif value_type == '%s':
-                original_value = float(value)
-                if measurement in raw:
-                    previous_time = sorted(list(raw[measurement].keys()))[-1]
+            if value_type == '%s':
+                original_value = value
+                if measurement in previous:
+                    (previous_time, previous_value) = previous[measurement]
                     delta_seconds = (taken - previous_time).total_seconds()
-                    value = (float(value) - raw[measurement][previous_time]) / delta_seconds
+                    value = (value - previous_value) / delta_seconds
                 else:
                     add_data = False
-                    raw[measurement] = {}
-                raw[measurement][taken] = original_value
+                previous[measurement] = (taken, original_value)
 
-            elif value_type in ('bytes'):
-                value = int(value)
+            if add_data:
+                yield (taken, measurement, value_type, value, unit)
 
-            elif value_type == 'bool':
-                value = (value == 'True')
+    def fill_rows(self, rows, group_times, first):
+        # Rows in measurement then time order, with the last value of each deduplicated measurement repeated at the
+        # times its collector ran after it, up to its next value, or until the heartbeat has passed. Rows from
+        # before the first sample time are only used for the value that's repeated.
+        current = None
+        last = None
+        times = []
+        i = 0
+        for row in rows:
+            (taken, measurement, value_type, value, unit) = row
+            if measurement != current:
+                if last is not None:
+                    yield from self.repeat_row(last, times[i:])
+                current = measurement
+                last = None
+                times = group_times.get(self.dedup.group(measurement), [])
+                i = 0
+            if self.dedup.is_deduped(measurement, value_type):
+                j = i
+                while j < len(times) and times[j] < taken:
+                    j += 1
+                if last is not None:
+                    yield from self.repeat_row(last, times[i:j])
+                i = j
+                last = row
+            if taken >= first:
+                yield row
+        if last is not None:
+            yield from self.repeat_row(last, times[i:])
 
-            elif value_type == 'date':
-                if value == '':
-                    value = None
-                else:
-                    value = datetime.strptime(value, datetime_format)
+    def repeat_row(self, row, times):
+        (taken, measurement, value_type, value, unit) = row
+        for t in times:
+            if t > taken and t - taken < self.dedup.heartbeat:
+                yield (t, measurement, value_type, value, unit)
 
-            elif value_type == 'string':
-                value = value
+    def update_fetch_cache(self, samples=None, start=None, end=None, measurements=None):
+        # Copy the rows the fetch cache needs from the database - those after the newest it has, and if the fetch
+        # reaches back past what it covers, the older ones. Returns a cursor on the cache and the scope to query.
+        cache = self.fetch_cache
+        (scope, covered_from, newest) = cache.get_scope(measurements)
+        layout = layouts[self.layout]
+        where, params = self.measurement_filter(measurements)
+        where_sql = ''.join([" AND {}".format(w) for w in where])
 
-            else:
-                raise Exception("Invalid type: {}".format(value_type))
+        self.connect_read()
+        try:
+            cur = self.read_connection.cursor()
+            if newest is not None:
+                cur.execute("{} {} WHERE taken > ?{}".format(layout['select'], layout['from'], where_sql), [newest - cache.overlap] + params)
+                cache.add_rows(scope, cur.fetchall(), batch_size=self.push_batch_size)
 
-            if add_data:
-                if measurement not in data:
-                    data[measurement] = Measurement(value, value_type, values={taken: value}, latest=taken, unit=unit)
+            if newest is None or not cache.covers(scope, samples=samples, start=start, end=end):
+                # Find the earliest row the fetch needs, as query_rows does
+                if samples is not None:
+                    end_sql = ''
+                    end_params = []
+                    if end is not None:
+                        end_sql = " AND taken <= ?"
+                        end_params = [end]
+                    cur.execute("SELECT distinct(taken) {} WHERE 1 = 1{}{} ORDER BY taken desc LIMIT ?".format(layout['from'], where_sql, end_sql), params + end_params + [samples + 1])
+                    takens = [taken for (taken,) in cur]
+                    needed_from = takens[-1] if len(takens) > 0 else None
                 else:
-                    data[measurement].value = value
-                    data[measurement].latest = taken
-                    data[measurement].values[taken] = value
+                    cur.execute("SELECT MAX(taken) {} WHERE taken < ?{}".format(layout['from'], where_sql), [start] + params)
+                    (needed_from,) = cur.fetchone()
+                    if needed_from is None:
+                        needed_from = start
+                if needed_from is not None and covered_from is None:
+                    cur.execute("{} {} WHERE taken >= ?{}".format(layout['select'], layout['from'], where_sql), [needed_from] + params)
+                    cache.add_rows(scope, cur.fetchall(), covered_from=needed_from, batch_size=self.push_batch_size)
+                elif needed_from is not None and needed_from < covered_from:
+                    cur.execute("{} {} WHERE taken >= ? AND taken < ?{}".format(layout['select'], layout['from'], where_sql), [needed_from, covered_from] + params)
+                    cache.add_rows(scope, cur.fetchall(), covered_from=needed_from, batch_size=self.push_batch_size)
+        except self.backend.Error as e:
+            self.read_connection.close()
+            raise e
+        self.disconnect_read()
+        return (cache.connection.cursor(), scope)
+
+    def add_sample(self, data, timestamps, measurement, value_type, unit, taken, value, history_type=None):
+        # Samples must be added in time order
+        if len(timestamps) == 0 or timestamps[-1] != taken:
+            timestamps.append(taken)
+        if measurement not in data:
+            data[measurement] = Measurement(value, value_type, values=History(timestamps, history_type or value_type), latest=taken, unit=unit)
+        else:
+            data[measurement].value = value
+            data[measurement].latest = taken
+        data[measurement].values.append(len(timestamps) - 1, value)
+
+    def choose_rollup(self, resolution):
+        resolution = parse_duration(resolution)
+        rollup = None
+        for name, period in sorted(rollup_periods.items(), key=lambda x: x[1]):
+            if period <= resolution:
+                rollup = name
+        return rollup
+
+    def query_rollups(self, cur, rollup, aggregate, samples=None, start=None, end=None, measurements=None):
+        if aggregate not in rollup_aggregates:
+            raise Exception("Invalid aggregate: {}".format(aggregate))
+        where, params = self.measurement_filter(measurements)
+        if end is not None:
+            where.append("period <= ?")
+            params.append(end)
+        if samples is not None:
+            if samples < 1:
+                raise Exception("Number of samples needs to be at least one")
+            cur.execute("SELECT distinct(period) FROM measurement_rollups WHERE resolution = ?{} ORDER BY period desc LIMIT ?".format(
+                ''.join([" AND {}".format(w) for w in where])), [rollup] + params + [samples])
+            periods = [period for (period,) in cur]
+            if len(periods) < samples:
+                raise Exception("There aren't enough samples in the database")
+            start = periods[-1]
+        where.append("period >= ?")
+        params.append(start)
+
+        cur.execute("SELECT period, measurement, value_type, unit, {}_value FROM measurement_rollups WHERE resolution = ?{} ORDER BY period".format(
+            aggregate, ''.join([" AND {}".format(w) for w in where])), [rollup] + params)
 
+        data = {}
+        timestamps = []
+        for (period, measurement, value_type, unit, value) in cur:
+            history_type = 'raw'
+            if value_type == 'bytes' and aggregate != 'avg':
+                value = int(value)
+                history_type = 'bytes'
+            self.add_sample(data, timestamps, measurement, value_type, unit, period, value, history_type)
+        return data
+
+    def aggregate(self, bucket, functions=('avg',), start=None, end=None, measurements=None, structured_data=True):
+        # Aggregate the samples of numeric measurements from the start time into buckets of the given width, with
+        # GROUP BY queries, so only one row per measurement per bucket is read from the database. Returns the data
+        # for each function, where each measurement's values are the function of each bucket, keyed by the time
+        # the bucket starts. The rate of a '%s' counter is its increase per second from the first to the last
+        # sample in the bucket.
+        for function in functions:
+            if function not in aggregate_functions:
+                raise Exception("Invalid aggregate function: {}".format(function))
+        if start is None:
+            raise Exception("Need to specify start time")
+        if isinstance(start, str):
+            start = parse_time(start)
+        if isinstance(end, str):
+            end = parse_time(end)
+        width = int(parse_duration(bucket).total_seconds())
+        if width < 1:
+            raise Exception("Bucket width needs to be at least one second")
+        # Buckets line up with midnight on the start day, so hourly buckets start on the hour
+        origin = start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        layout = layouts[self.layout]
+        where = ["value_type IN ({})".format(', '.join(['?'] * len(rollup_types))), "taken >= ?"]
+        params = list(rollup_types) + [start]
+        if end is not None:
+            where.append("taken <= ?")
+            params.append(end)
+        measurement_where, measurement_params = self.measurement_filter(measurements)
+        where_sql = ' AND '.join(where + measurement_where)
+        params += measurement_params
+
+        query = ("SELECT measurement, value_type, unit, {bucket} AS bucket, MIN({number}) AS min_value, MAX({number}) AS max_value, AVG({number}) AS avg_value, "
+            "COUNT(*) AS count_value, MIN(taken) AS first_taken, MAX(taken) AS last_taken {from_sql} WHERE {where} GROUP BY measurement, value_type, unit, bucket").format(
+            bucket=self.backend.bucket_sql(), number=layout['number'], from_sql=layout['from'], where=where_sql)
+        query_params = [origin, width] + params
+        if 'last' in functions:
+            # The value of the last sample in each bucket is found by joining on its time
+            query = ("SELECT g.*, l.last_value FROM ({}) g JOIN (SELECT taken, measurement, {} AS last_value {} WHERE {}) l "
+                "ON l.measurement = g.measurement AND l.taken = g.last_taken").format(query, layout['number'], layout['from'], where_sql)
+            query_params += params
+        query += " ORDER BY measurement, bucket"
+
+        self.connect_read()
+        cur = self.read_connection.cursor()
+        try:
+            cur.execute(query, query_params)
+            rows = cur.fetchall()
+        except self.backend.Error as e:
+            self.read_connection.close()
+            raise e
         self.disconnect_read()
 
+        results = dict([(function, {}) for function in functions])
+        # Bucket start times, in order, shared by the history of all measurements
+        buckets = sorted(set([row[3] for row in rows]))
+        timestamps = [origin + timedelta(seconds=width * b) for b in buckets]
+        positions = dict([(b, i) for i, b in enumerate(buckets)])
+        previous = None
+        for row in rows:
+            (measurement, value_type, unit, b, min_value, max_value, avg_value, count_value, first_taken, last_taken) = row[0:10]
+            # Samples taken at the same time more than once match the join more than once
+            if (measurement, b) == previous:
+                continue
+            previous = (measurement, b)
+            for function in functions:
+                function_type = value_type
+                history_type = 'raw'
+                if function == 'count':
+                    value = count_value
+                    function_type = 'raw'
+                    history_type = 'bytes'
+                elif function == 'rate':
+                    # Only counters have a rate
+                    if value_type != '%s':
+                        continue
+                    seconds = (last_taken - first_taken).total_seconds()
+                    value = None if seconds == 0 else (max_value - min_value) / seconds
+                else:
+                    value = {'min': min_value, 'max': max_value, 'avg': avg_value, 'last': row[-1]}[function]
+                    if value_type == 'bytes' and function != 'avg':
+                        value = int(value)
+                        history_type = 'bytes'
+                data = results[function]
+                if measurement not in data:
+                    data[measurement] = Measurement(value, function_type, values=History(timestamps, history_type), unit=unit)
+                data[measurement].value = value
+                data[measurement].latest = timestamps[positions[b]]
+                data[measurement].values.append(positions[b], value)
+
         if structured_data:
-            return structure_data(data);
-        return data
+            return dict([(function, structure_data(data)) for function, data in results.items()])
+        return results
+
+    def compact(self, start=None, verbose=False):
+        # Update hourly rollups from raw samples, and daily rollups from hourly ones, from the start time.
+        # Without a start time, this carries on from the last hourly rollup, which is recalculated as it
+        # may have been made before the hour was over.
+        if isinstance(start, str):
+            start = parse_time(start)
+        self.connect_admin()
+        cur = self.admin_connection.cursor()
+        rows = 0
+        try:
+            if start is None:
+                cur.execute("SELECT MAX(period) FROM measurement_rollups WHERE resolution = 'hour'")
+                (start,) = cur.fetchone()
+            if start is None:
+                cur.execute("SELECT MIN(taken) {}".format(layouts[self.layout]['from']))
+                (start,) = cur.fetchone()
+            if start is None:
+                self.disconnect_admin()
+                return rows
+            now = datetime.now()
+
+            # Hourly rollups, a day of raw samples at a time
+            period = rollup_period_start(start, 'hour')
+            while period <= now:
+                chunk_end = period + timedelta(days=1)
+                data = self.query(cur, start=period, end=chunk_end - timedelta(seconds=1))
+                rows += self.save_rollups(cur, self.rollup_samples(data, 'hour'))
+                self.admin_connection.commit()
+                if verbose:
+                    err("Compacted hourly rollups from {} to {} ({} rows so far)".format(period, chunk_end, rows))
+                period = chunk_end
+
+            # Daily rollups, from a month of hourly rollups at a time
+            period = rollup_period_start(start, 'day')
+            while period <= now:
+                chunk_end = period + timedelta(days=30)
+                cur.execute("SELECT period, measurement, value_type, unit, min_value, max_value, avg_value, last_value, samples FROM measurement_rollups "
+                    "WHERE resolution = 'hour' AND period >= ? AND period < ? ORDER BY period", (period, chunk_end))
+                rows += self.save_rollups(cur, self.rollup_rollups(cur.fetchall(), 'day'))
+                self.admin_connection.commit()
+                if verbose:
+                    err("Compacted daily rollups from {} to {} ({} rows so far)".format(period, chunk_end, rows))
+                period = chunk_end
+        except self.backend.Error as e:
+            self.admin_connection.close()
+            raise e
+        self.disconnect_admin()
+        return rows
+
+    def rollup_samples(self, data, rollup):
+        # Roll up each numeric measurement's samples into periods. '%s' counters have already been turned into rates.
+        rollups = {}
+        for measurement, m in data.items():
+            if m.type not in rollup_types:
+                continue
+            for taken, value in m.values.items():
+                if value is None:
+                    continue
+                key = (measurement, rollup_period_start(taken, rollup))
+                if key not in rollups:
+                    rollups[key] = [m.type, m.unit, value, value, value, value, 1]
+                else:
+                    r = rollups[key]
+                    r[2] = min(r[2], value)
+                    r[3] = max(r[3], value)
+                    r[4] += value
+                    r[5] = value
+                    r[6] += 1
+        return [(rollup, period, measurement, r[0], r[1], r[2], r[3], r[4] / r[6], r[5], r[6]) for (measurement, period), r in rollups.items()]
+
+    def rollup_rollups(self, rows, rollup):
+        # Roll up finer rollups (ordered by period) into coarser ones, weighting averages by number of samples
+        rollups = {}
+        for (period, measurement, value_type, unit, min_value, max_value, avg_value, last_value, samples) in rows:
+            key = (measurement, rollup_period_start(period, rollup))
+            if key not in rollups:
+                rollups[key] = [value_type, unit, min_value, max_value, avg_value * samples, last_value, samples]
+            else:
+                r = rollups[key]
+                r[2] = min(r[2], min_value)
+                r[3] = max(r[3], max_value)
+                r[4] += avg_value * samples
+                r[5] = last_value
+                r[6] += samples
+        return [(rollup, period, measurement, r[0], r[1], r[2], r[3], r[4] / r[6], r[5], r[6]) for (measurement, period), r in rollups.items()]
+
+    def save_rollups(self, cur, rows):
+        for i in range(0, len(rows), self.push_batch_size):
+            cur.executemany("REPLACE INTO measurement_rollups (resolution, period, measurement, value_type, unit, min_value, max_value, avg_value, last_value, samples) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows[i:i + self.push_batch_size])
+        return len(rows)
+
+    def measurement_filter(self, measurements):
+        # Patterns can use * as a wildcard. A pattern without a wildcard matches that measurement and everything under it.
+        if measurements is None:
+            return ([], [])
+        if isinstance(measurements, str):
+            measurements = [measurements]
+        conditions = []
+        params = []
+        for pattern in measurements:
+            escaped = pattern.replace('!', '!!').replace('%', '!%').replace('_', '!_').replace('*', '%')
+            if '*' in pattern:
+                conditions.append("measurement LIKE ? ESCAPE '!'")
+                params.append(escaped)
+            else:
+                conditions.append("measurement = ? OR measurement LIKE ? ESCAPE '!'")
+                params += [pattern, escaped + '.%']
+        return (["({})".format(' OR '.join(conditions))], params)
+
+    def parse_value(self, value_type, value):
+        # Values in the legacy layout are all stored as strings
+        if value_type in ('%', '%s', 'raw'):
+            return float(value)
+        elif value_type == 'bytes':
+            return int(value)
+        elif value_type == 'bool':
+            return (value == 'True')
+        elif value_type == 'date':
+            if value == '':
+                return None
+            return datetime.strptime(value, datetime_format)
+        elif value_type == 'string':
+            return value
+        raise Exception("Invalid type: {}".format(value_type))
+
+    def decode_value(self, value_type, value, value_text):
+        # Values in the normalized layout are stored as numbers, apart from dates and strings
+        if value_type in ('%', '%s', 'raw'):
+            return value
+        elif value_type == 'bytes':
+            return None if value is None else int(value)
+        elif value_type == 'bool':
+            return None if value is None else (value != 0)
+        elif value_type == 'date':
+            if value_text is None or value_text == '':
+                return None
+            return datetime.strptime(value_text, datetime_format)
+        elif value_type == 'string':
+            return value_text
+        raise Exception("Invalid type: {}".format(value_type))
+
+    def encode_value(self, value_type, value):
+        # Returns the (value, value_text) columns for the normalized layout
+        if value is None:
+            return (None, None)
+        if value_type in ('date', 'string'):
+            return (None, str(value))
+        if value_type == 'bool':
+            return (1.0 if value is True or value == 'True' else 0.0, None)
+        return (float(value), None)
 
     def push(self, data, now):
-        self.connect_push()
+        if not self.self_measurements:
+            return self.push_samples([(now, data)])
+
+        # A process that pushes once and exits gets the last push's stats from the cache
+        stats_filename = self.get_stats_filename('push_stats.json')
+        if self.push_stats is None and not self.persistent and stats_filename is not None:
+            self.push_stats = read_json_file(stats_filename)
+        # Fetches of this host from the command line save their stats for the next push
+        fetch_stats_filename = self.get_stats_filename('fetch_stats-{}.json'.format(self.host))
+        fetch_stats = None
+        if fetch_stats_filename is not None:
+            fetch_stats = read_json_file(fetch_stats_filename)
+        if fetch_stats is not None:
+            self.fetch_stats = fetch_stats
+        data = dict(data)
+        data.update(self.get_self_measurements())
+        stats = self.push_samples([(now, data)])
+        # Each fetch's stats are only pushed once
+        self.fetch_stats = None
+        if fetch_stats is not None:
+            try:
+                os.remove(fetch_stats_filename)
+            except OSError:
+                pass
+        if not self.persistent and stats_filename is not None:
+            try:
+                write_json_file(stats_filename, stats)
+            except OSError as e:
+                err("Could not write push stats:", e)
+        return stats
+
+    def save_fetch_stats(self):
+        # Saves the stats of the last fetch for the next push of this host
+        if not self.self_measurements or self.fetch_stats is None:
+            return
+        filename = self.get_stats_filename('fetch_stats-{}.json'.format(self.host))
+        if filename is None:
+            return
+        try:
+            write_json_file(filename, self.fetch_stats)
+        except OSError as e:
+            err("Could not write fetch stats:", e)
+
+    def get_stats_filename(self, name):
+        # Stats are never worth failing a push or fetch over
+        try:
+            return os.path.join(get_cache_dir(), name)
+        except OSError as e:
+            err("Could not use the cache directory for stats:", e)
+            return None
+
+    def get_self_measurements(self):
+        data = {}
+        for name, stats in (('push', self.push_stats), ('fetch', self.fetch_stats)):
+            if stats is not None:
+                for stat, value in stats.items():
+                    data["systemmonitor.self.{}.{}".format(name, stat)] = Measurement(float(value), 'raw', unit=('s' if stat == 'seconds' else None))
+        return data
+
+    def push_samples(self, samples, replay=False):
+        # Push a list of (taken, data) samples in one transaction.
+        # Replayed samples may already have been pushed, if the spool's progress wasn't saved, so rows already in
+        # the database are left as they are.
+        started = time.perf_counter()
+        if self.push_connection is None:
+            self.connect_push()
         cur = self.push_connection.cursor()
 
-        for key, value_data in data.items():
+        # Leave out deduplicated measurements that haven't changed
+        deduplicated = 0
+        if self.dedup is not None:
+            count = sum([len(data) for (now, data) in samples])
+            (samples, dedup_state) = self.dedup.filter(samples)
+            deduplicated = count - sum([len(data) for (now, data) in samples])
+
+        keys = [key for (now, data) in samples for key in data.keys()]
+        if self.layout == 'normalized':
             try:
-                cur.execute("INSERT INTO measurements (taken, measurement, value_type, value, unit) VALUES (?, ?, ?, ?, ?)", (now, key, value_data.type, str(value_data.value), value_data.unit))
-            except mariadb.Error as e:
-                self.push_connection.close()
+                ids = self.get_measurement_ids(cur, dict([(key, value_data) for (now, data) in samples for key, value_data in data.items()]))
+            except self.backend.Error as e:
+                err("Could not look up measurement ids:", e)
+                self.disconnect_push()
                 raise e
+            rows = [(ids[key], now) + self.encode_value(value_data.type, value_data.value) for (now, data) in samples for key, value_data in data.items()]
+        else:
+            rows = [(now, key, value_data.type, str(value_data.value), value_data.unit) for (now, data) in samples for key, value_data in data.items()]
+            if replay and len(samples) > 0:
+                # The legacy table has no key to ignore duplicates by, so look for them
+                takens = sorted(set([parse_time(now) if isinstance(now, str) else now for (now, data) in samples]))
+                try:
+                    cur.execute("SELECT taken, measurement FROM measurements WHERE taken IN ({})".format(', '.join(['?'] * len(takens))), takens)
+                    existing = set([(taken, measurement) for (taken, measurement) in cur])
+                except self.backend.Error as e:
+                    self.disconnect_push()
+                    raise e
+                rows = [row for row in rows if ((parse_time(row[0]) if isinstance(row[0], str) else row[0]), row[1]) not in existing]
+                keys = [row[1] for row in rows]
+
+        # Insert in batches, each of which is sent to the server in one round trip
+        insert_sql = layouts[self.layout]['insert']
+        if replay:
+            insert_sql = insert_sql.replace('INSERT', 'INSERT IGNORE', 1)
+        batches = 0
+        for i in range(0, len(rows), self.push_batch_size):
+            batch = rows[i:i + self.push_batch_size]
+            try:
+                cur.executemany(insert_sql, batch)
+            except self.backend.Error as e:
+                err("Insert failed for batch {} ({} rows, starting at {}): {}".format(batches + 1, len(batch), keys[i], e))
+                self.disconnect_push()
+                raise e
+            batches += 1
+
+        try:
+            self.push_connection.commit()
+        except self.backend.Error as e:
+            self.disconnect_push()
+            raise e
+        if self.dedup is not None:
+            self.dedup.save(dedup_state)
+        if not self.persistent:
+            self.disconnect_push()
+
+        # The samples are already committed, so a failed rollup is reported rather than failing the push. The
+        # rollups are caught up by the next push or compact.
+        if self.rollup_on_push and len(samples) > 0:
+            try:
+                self.compact(start=min([parse_time(now) if isinstance(now, str) else now for (now, data) in samples]))
+            except Exception as e:
+                err("Could not update rollups:", e)
+
+        self.push_stats = {
+            'rows': len(rows),
+            'batches': batches,
+            'seconds': time.perf_counter() - started,
+        }
+        if self.dedup is not None:
+            self.push_stats['deduplicated'] = deduplicated
+        return self.push_stats
+
+    def get_measurement_ids(self, cur, data):
+        # Look up the ids of measurements not seen before by this object, adding any new ones to the dictionary
+        missing = [key for key in data.keys() if key not in self.measurement_ids]
+        for i in range(0, len(missing), self.push_batch_size):
+            batch = missing[i:i + self.push_batch_size]
+            cur.executemany("INSERT IGNORE INTO measurement_names (measurement, value_type, unit) VALUES (?, ?, ?)",
+                [(key, data[key].type, data[key].unit) for key in batch])
+            cur.execute("SELECT id, measurement FROM measurement_names WHERE measurement IN ({})".format(', '.join(['?'] * len(batch))), batch)
+            for (measurement_id, measurement) in cur:
+                self.measurement_ids[measurement] = measurement_id
+        return self.measurement_ids
 
-        self.push_connection.commit()
-        self.disconnect_push()
+    def migrate(self, chunk_size=100, verbose=False):
+        # Copy data from the legacy table into the normalized tables, a chunk of samples at a time.
+        # Copying carries on after the latest sample already migrated, so it can be stopped and run again
+        # at any time, and run one last time once collection has switched to the normalized layout.
+        self.connect_admin()
+        cur = self.admin_connection.cursor()
+        try:
+            cur.execute("SELECT MAX(taken) FROM measurement_values WHERE taken <= (SELECT MAX(taken) FROM measurements)")
+            (last_taken,) = cur.fetchone()
+            total = 0
+            while True:
+                if last_taken is None:
+                    cur.execute("SELECT distinct(taken) FROM measurements ORDER BY taken LIMIT ?", (chunk_size,))
+                else:
+                    cur.execute("SELECT distinct(taken) FROM measurements WHERE taken > ? ORDER BY taken LIMIT ?", (last_taken, chunk_size))
+                samples = [taken for (taken,) in cur]
+                if len(samples) == 0:
+                    break
+                chunk = (samples[0], samples[-1])
+
+                cur.execute("INSERT IGNORE INTO measurement_names (measurement, value_type, unit) "
+                    "SELECT measurement, MAX(value_type), MAX(unit) FROM measurements WHERE taken BETWEEN ? AND ? GROUP BY measurement", chunk)
+                cur.execute("INSERT IGNORE INTO measurement_values (measurement_id, taken, value, value_text) "
+                    "SELECT n.id, m.taken, "
+                    "CASE WHEN m.value_type IN ('%', '%s', 'raw', 'bytes') THEN m.value + 0 WHEN m.value_type = 'bool' THEN m.value = 'True' END, "
+                    "CASE WHEN m.value_type IN ('date', 'string') THEN m.value END "
+                    "FROM measurements m JOIN measurement_names n ON n.measurement = m.measurement WHERE m.taken BETWEEN ? AND ?", chunk)
+                total += cur.rowcount
+                self.admin_connection.commit()
+                if verbose:
+                    err("Migrated samples {} to {} ({} rows so far)".format(chunk[0], chunk[1], total))
+                last_taken = samples[-1]
+        except self.backend.Error as e:
+            self.admin_connection.close()
+            raise e
+        self.disconnect_admin()
+        return total
+
+    def prune(self, chunk_size=1000, pause=0.1, verbose=False):
+        # Delete samples older than the retention period of the first retention pattern their measurement matches.
+        # Deletes are done in small chunks, each in its own transaction, so the table is never locked for long.
+        self.connect_admin()
+        cur = self.admin_connection.cursor()
+        now = datetime.now().replace(microsecond=0)
+        total = 0
+        earlier_patterns = []
+        try:
+            for pattern, retention in self.retention.items():
+                cutoff = now - parse_duration(retention)
+                where, params = self.measurement_filter(pattern)
+                for earlier_pattern in earlier_patterns:
+                    earlier_where, earlier_params = self.measurement_filter(earlier_pattern)
+                    where += ["NOT {}".format(w) for w in earlier_where]
+                    params += earlier_params
+                earlier_patterns.append(pattern)
+                where_sql = ' AND '.join(where)
+
+                if self.layout == 'normalized':
+                    cur.execute("SELECT id FROM measurement_names WHERE {}".format(where_sql), params)
+                    ids = [measurement_id for (measurement_id,) in cur]
+                    chunks = [(ids[i:i + 1000]) for i in range(0, len(ids), 1000)]
+                    deletes = [("DELETE FROM measurement_values WHERE measurement_id IN ({}) AND taken < ? LIMIT ?".format(', '.join(['?'] * len(chunk))),
+                        chunk + [cutoff]) for chunk in chunks]
+                else:
+                    deletes = [("DELETE FROM measurements WHERE {} AND taken < ? LIMIT ?".format(where_sql), params + [cutoff])]
+
+                deleted = 0
+                for (delete_sql, delete_params) in deletes:
+                    while True:
+                        cur.execute(delete_sql, delete_params + [chunk_size])
+                        rowcount = cur.rowcount
+                        self.admin_connection.commit()
+                        deleted += rowcount
+                        if rowcount < chunk_size:
+                            break
+                        time.sleep(pause)
+                if verbose:
+                    err("Pruned {} rows of {} older than {}".format(deleted, pattern, cutoff))
+                total += deleted
+        except self.backend.Error as e:
+            self.admin_connection.close()
+            raise e
+        self.disconnect_admin()
+        return total
 
     def connect_read(self):
         if not self.db_read:
             raise Exception("Read DB config not provided")
-        try:
-            conn = mariadb.connect(
-                user = self.db_read_user,
-                password = self.db_read_pass,
-                host = self.db_host,
-                database = self.db_schema
-            )
-        except mariadb.Error as e:
-            raise e
-        self.read_connection = conn
+        if self.pooled:
+            conn = take_read_connection(self.read_pool_key(), self.backend.Error)
+            if conn is not None:
+                self.read_connection = conn
+                return
+        self.read_connection = self.backend.connect(self.db_read_user, self.db_read_pass)
 
     def disconnect_read(self):
+        if self.pooled and give_read_connection(self.read_pool_key(), self.read_connection, self.backend.Error):
+            return
         self.read_connection.close()
 
+    def read_pool_key(self):
+        return self.backend.pool_key(self.db_read_user)
+
     def connect_push(self):
         if not self.db_push:
             raise Exception("Push DB config not provided")
-        try:
-            conn = mariadb.connect(
-                user = self.db_push_user,
-                password = self.db_push_pass,
-                host = self.db_host,
-                database = self.db_schema
-            )
-            conn.autocommit = False
-        except mariadb.Error as e:
-            raise e
-        self.push_connection = conn
+        self.push_connection = self.backend.connect(self.db_push_user, self.db_push_pass, autocommit=False)
 
     def disconnect_push(self):
-        self.push_connection.close()
+        try:
+            self.push_connection.close()
+        finally:
+            self.push_connection = None
+
+    def connect_admin(self):
+        if not self.db_admin:
+            raise Exception("Admin DB config not provided")
+        self.admin_connection = self.backend.connect(self.db_admin_user, self.db_admin_pass, autocommit=False)
+
+    def disconnect_admin(self):
+        self.admin_connection.close()
+
+
+# Read connections that aren't in use, kept by pooled Database objects, by backend, database and user
+read_pool = {}
+read_pool_lock = threading.Lock()
+read_pool_size = 8
+
+def take_read_connection(key, error):
+    while True:
+        with read_pool_lock:
+            if len(read_pool.get(key, [])) == 0:
+                return None
+            conn = read_pool[key].pop()
+        # The server may have closed the connection while it was idle
+        try:
+            conn.ping()
+            return conn
+        except error:
+            conn.close()
+
+def give_read_connection(key, conn, error):
+    # End the connection's transaction, so the next fetch doesn't read from an old snapshot
+    try:
+        conn.rollback()
+    except error:
+        return False
+    with read_pool_lock:
+        idle = read_pool.setdefault(key, [])
+        if len(idle) >= read_pool_size:
+            return False
+        idle.append(conn)
+    return True
+
+def close_read_pool():
+    with read_pool_lock:
+        for idle in read_pool.values():
+            for conn in idle:
+                conn.close()
+        read_pool.clear()
+
+def get_database_hosts():
+    # All hosts configured with a read database user, or a backend without users
+    return sorted([host for host, host_config in get_all_config().items()
+        if isinstance(host_config, dict) and 'db' in host_config and
+            ('read' in host_config['db'] or not backends.get(host_config['db'].get('backend', 'mariadb'), backends['mariadb']).needs_users)])
+
+def fetch_hosts(hosts, max_workers=8, **kwargs):
+    # Fetch from several hosts at once, with the same arguments as Database.fetch, using pooled read connections.
+    # Returns the data for each host fetched from, and the exception for each host that failed.
+    results = {}
+    errors = {}
+    if len(hosts) == 0:
+        return results, errors
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(hosts))) as executor:
+        futures = [(host, executor.submit(lambda h: Database(h, pooled=True).fetch(**kwargs), host)) for host in hosts]
+        for host, future in futures:
+            try:
+                results[host] = future.result()
+            except Exception as e:
+                errors[host] = e
+    return results, errors
+
+def rollup_period_start(taken, rollup):
+    if rollup == 'day':
+        return taken.replace(hour=0, minute=0, second=0, microsecond=0)
+    return taken.replace(minute=0, second=0, microsecond=0)
+
+
+layouts = {
+    # One row per measurement per sample, with every value stored as a string
+    'legacy': {
+        'table': 'measurements',
+        'from': "FROM measurements",
+        'select': "SELECT taken, measurement, value_type, value, NULL AS value_text, unit",
+        'number': "value + 0",
+        'names': "FROM measurements",
+        'insert': "INSERT INTO measurements (taken, measurement, value_type, value, unit) VALUES (?, ?, ?, ?, ?)",
+    },
+    # Measurement names, types and units are stored once, and values as numbers
+    'normalized': {
+        'table': 'measurement_values',
+        'from': "FROM measurement_values v JOIN measurement_names n ON n.id = v.measurement_id",
+        'select': "SELECT taken, measurement, value_type, value, value_text, unit",
+        'number': "value",
+        'names': "FROM measurement_names",
+        'insert': "INSERT INTO measurement_values (measurement_id, taken, value, value_text) VALUES (?, ?, ?, ?)",
+    },
+}
+
+# Rollups of numeric measurements, with the length of each period
+rollup_periods = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+rollup_types = ('%', '%s', 'raw', 'bytes')
+rollup_aggregates = ('min', 'max', 'avg', 'last')
+aggregate_functions = ('min', 'max', 'avg', 'count', 'last', 'rate')
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+from systemmonitor.common import *
+
+from datetime import *
+
+
+class Dedup():
+
+    # Measurements that rarely change are only pushed when their value changes, or when the heartbeat has passed
+    # since they were last pushed. The last value pushed of each is kept in a state file. Fetches repeat the last
+    # value at the times its collector ran in between, for up to the heartbeat, so the data looks the same as if it
+    # had been pushed every time.
+
+    def __init__(self, host, config):
+        if not isinstance(config, dict):
+            config = {}
+        self.filename = config.get('file', os.path.join(get_cache_dir(), 'dedup-{}.json'.format(host)))
+        self.heartbeat = parse_duration(config.get('heartbeat', '1h'))
+        self.types = set(config.get('types', default_dedup_types))
+        # Counters change every time, so are never deduplicated
+        self.types.discard('%s')
+        self.patterns = None
+        if 'measurements' in config:
+            self.patterns = [pattern_regex(pattern) for pattern in config['measurements']]
+        # Last value pushed of each measurement, loaded when first pushed
+        self.last = None
+
+    def is_deduped(self, key, value_type):
+        if value_type not in self.types:
+            return False
+        return self.patterns is None or any([pattern.match(key) for pattern in self.patterns])
+
+    def group(self, key):
+        # Measurements from the same collector share the first two levels of their names, apart from the timings
+        # of each collector
+        depth = 4 if key.startswith('systemmonitor.self.collector.') else 2
+        return '.'.join(key.split('.')[0:depth])
+
+    def filter(self, samples):
+        # Returns the samples with the measurements that don't need to be pushed left out, and the values that
+        # will have been pushed, to save once they're committed
+        if self.last is None:
+            self.last = read_json_file(self.filename, {})
+        last = dict(self.last)
+        filtered = []
+        for (now, data) in samples:
+            taken = parse_time(now) if isinstance(now, str) else now
+            pushed = {}
+            skipped = {}
+            for key, m in data.items():
+                if self.is_deduped(key, m.type):
+                    value = [m.type, None if m.value is None else str(m.value), m.unit]
+                    last_taken = None
+                    if key in last:
+                        last_taken = parse_time(last[key][0])
+                        if last[key][1] == value and last_taken <= taken < last_taken + self.heartbeat:
+                            skipped.setdefault(self.group(key), []).append((key, value))
+                            continue
+                    # Samples older than the last pushed, such as from a spool, are always pushed
+                    if last_taken is None or taken >= last_taken:
+                        last[key] = [taken.strftime(datetime_format), value]
+                pushed[key] = m
+            # Fetches only fill in a measurement at the times its collector ran, so each collector that ran has
+            # at least one measurement pushed
+            pushed_groups = set([self.group(key) for key in pushed.keys()])
+            for group, values in skipped.items():
+                if group not in pushed_groups:
+                    (key, value) = min(values)
+                    pushed[key] = data[key]
+                    last[key] = [taken.strftime(datetime_format), value]
+            filtered.append((now, pushed))
+        return (filtered, last)
+
+    def save(self, last):
+        self.last = last
+        try:
+            write_json_file(self.filename, last)
+        except OSError as e:
+            err("Could not write dedup state:", e)
+
+
+# Types of measurements that are deduplicated, unless others are configured
+default_dedup_types = ['bool', 'date', 'string', 'bytes']
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+from systemmonitor.common import *
+
+import re
+import threading
+
+
+# Block devices are discovered once per collection run, and shared by all collectors
+_devices_lock = threading.Lock()
+_devices = None
+
+
+def get_block_devices():
+    # Returns devices in the same structure as "lsblk -pnJb -o NAME,FSAVAIL,FSUSE%"
+    global _devices
+    with _devices_lock:
+        if _devices is None:
+            try:
+                _devices = scan_sysfs()
+            except OSError:
+                _devices = scan_lsblk()
+        return _devices
+
+def reset_block_devices():
+    global _devices
+    with _devices_lock:
+        _devices = None
+
+def scan_lsblk():
+    result = cmd('lsblk -pnJb -o NAME,FSAVAIL,FSUSE%')
+    devices = json.loads(result)
+    return devices['blockdevices']
+
+def scan_sysfs(sys_block='/sys/block'):
+    mounts_by_dev, mounts_by_source = read_mounts()
+    devices = []
+    # Every disk, partition and stacked device by sysfs name, and the devices each stacked device is on
+    nodes = {}
+    holders = []
+    for name in sorted(os.listdir(sys_block)):
+        sys_path = os.path.join(sys_block, name)
+        dev = read_sysfs(sys_path, 'dev')
+        # Skip RAM disks and unused loop devices
+        if dev is None or dev.startswith('1:'):
+            continue
+        if name.startswith('loop') and read_sysfs(sys_path, 'loop/backing_file') is None:
+            continue
+        device = sysfs_device(name, dev, mounts_by_dev, mounts_by_source, display_name=sysfs_display_name(sys_path))
+        nodes[name] = device
+
+        partitions = []
+        for child in os.listdir(sys_path):
+            child_path = os.path.join(sys_path, child)
+            partition = read_sysfs(child_path, 'partition')
+            if partition is not None:
+                partition_device = sysfs_device(child, read_sysfs(child_path, 'dev'), mounts_by_dev, mounts_by_source)
+                nodes[child] = partition_device
+                partitions.append((int(partition), partition_device))
+        if len(partitions) > 0:
+            device['children'] = [p for (_, p) in sorted(partitions, key=lambda x: x[0])]
+
+        # Devices stacked on top of others, such as LVM, dm-crypt and md RAID, are nested under each device
+        # they're on, as lsblk shows them
+        slaves_path = os.path.join(sys_path, 'slaves')
+        slaves = sorted(os.listdir(slaves_path)) if os.path.isdir(slaves_path) else []
+        if len(slaves) > 0:
+            holders.append((device, slaves))
+        else:
+            devices.append(device)
+
+    for (device, slaves) in holders:
+        for slave in slaves:
+            if slave in nodes:
+                nodes[slave].setdefault('children', []).append(device)
+    return devices
+
+def sysfs_display_name(sys_path):
+    # Device mapper devices are named by lsblk -p as /dev/mapper/<name>, rather than /dev/dm-<n>
+    dm_name = read_sysfs(sys_path, 'dm/name')
+    if dm_name is not None:
+        return '/dev/mapper/' + dm_name
+    return None
+
+def sysfs_device(name, dev, mounts_by_dev, mounts_by_source, display_name=None):
+    # Names containing '/' are written with '!' in sysfs
+    device_path = '/dev/' + name.replace('!', '/')
+    device = {
+        'name': display_name or device_path,
+        'fsavail': None,
+        'fsuse%': None,
+    }
+    mount_point = mounts_by_dev.get(dev, mounts_by_source.get(device_path))
+    if mount_point is not None:
+        try:
+            vfs = os.statvfs(mount_point)
+        except OSError:
+            return device
+        if vfs.f_blocks > 0:
+            device['fsavail'] = vfs.f_bavail * vfs.f_frsize
+            device['fsuse%'] = "{:.0f}%".format((vfs.f_blocks - vfs.f_bfree) / vfs.f_blocks * 100)
+    return device
+
+def read_mounts():
+    # Map both major:minor and source device to the first mount point found
+    mounts_by_dev = {}
+    mounts_by_source = {}
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields = line.split()
+            separator = fields.index('-')
+            dev = fields[2]
+            mount_point = unescape_mount_field(fields[4])
+            source = unescape_mount_field(fields[separator + 2])
+            if dev not in mounts_by_dev:
+                mounts_by_dev[dev] = mount_point
+            if source.startswith('/dev/'):
+                source = os.path.realpath(source)
+                if source not in mounts_by_source:
+                    mounts_by_source[source] = mount_point
+    return mounts_by_dev, mounts_by_source
+
+def unescape_mount_field(field):
+    # Spaces, tabs, newlines and backslashes are octal-escaped in mountinfo
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+def read_sysfs(path, name):
+    try:
+        with open(os.path.join(path, name)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+from systemmonitor.common import *
+from systemmonitor.backends import SQLiteBackend
+
+from datetime import *
+
+
+class FetchCache():
+
+    # A local SQLite copy of the rows fetched from a host's database, for each set of measurement patterns fetched.
+    # Every row in the database from a scope's covered_from time up to its newest cached row is in the cache, so a
+    # fetch only needs the rows newer than that, and any older rows it reaches back to. The file can be shared by
+    # several processes - rows are copied and evicted in short transactions, and copying a row twice replaces it.
+
+    def __init__(self, host, config):
+        if not isinstance(config, dict):
+            config = {}
+        self.backend = SQLiteBackend({
+            'file': config.get('file', os.path.join(get_cache_dir(), 'fetch-{}.db'.format(host))),
+            'timeout': config.get('timeout', 30),
+        }, schema=fetch_cache_schema)
+        self.max_age = parse_duration(config.get('max_age', '7d'))
+        self.max_rows = config.get('max_rows', 1000000)
+        # Rows taken this long before the newest cached row are fetched again, to pick up samples pushed late
+        self.overlap = parse_duration(config.get('overlap', 0))
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = self.backend.connect()
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get_scope(self, measurements):
+        # Returns the id, covered_from time and newest row time of the scope for these measurement patterns
+        if measurements is None:
+            key = '*'
+        else:
+            key = json.dumps(sorted([measurements] if isinstance(measurements, str) else measurements))
+        cur = self.connect().cursor()
+        cur.execute("INSERT OR IGNORE INTO cache_scopes (measurements) VALUES (?)", [key])
+        # A scope whose rows have all been evicted starts again
+        cur.execute("UPDATE cache_scopes SET covered_from = NULL WHERE measurements = ? AND NOT EXISTS "
+            "(SELECT 1 FROM cached_rows WHERE scope = cache_scopes.id)", [key])
+        self.connection.commit()
+        cur.execute("SELECT id, covered_from FROM cache_scopes WHERE measurements = ?", [key])
+        (scope, covered_from) = cur.fetchone()
+        cur.execute("SELECT MAX(taken) FROM cached_rows WHERE scope = ?", [scope])
+        (newest,) = cur.fetchone()
+        if covered_from is not None:
+            covered_from = datetime.fromisoformat(covered_from)
+        return (scope, covered_from, newest)
+
+    def layout(self, scope):
+        # Rows are stored as they were read from the database, so they're decoded the same way
+        return {
+            'table': 'cached_rows',
+            'from': "FROM (SELECT * FROM cached_rows WHERE scope = {}) c".format(int(scope)),
+            'select': "SELECT taken, measurement, value_type, value, value_text, unit",
+        }
+
+    def covers(self, scope, samples=None, start=None, end=None):
+        # Whether the cache has every row needed to fetch these samples
+        cur = self.connection.cursor()
+        if samples is not None:
+            params = [scope]
+            end_sql = ''
+            if end is not None:
+                end_sql = " AND taken <= ?"
+                params.append(end)
+            cur.execute("SELECT COUNT(*) FROM (SELECT distinct(taken) FROM cached_rows WHERE scope = ?{} ORDER BY taken desc LIMIT ?) t".format(end_sql), params + [samples + 1])
+            (count,) = cur.fetchone()
+            return count > samples
+        # The sample before the start time, if it's cached, is the one in the database
+        cur.execute("SELECT MAX(taken) FROM cached_rows WHERE scope = ? AND taken < ?", [scope, start])
+        (earliest,) = cur.fetchone()
+        return earliest is not None
+
+    def add_rows(self, scope, rows, covered_from=None, batch_size=1000):
+        # Add (taken, measurement, value_type, value, value_text, unit) rows, and extend the scope back to
+        # covered_from if given, in one transaction
+        cur = self.connection.cursor()
+        count = 0
+        try:
+            for i in range(0, len(rows), batch_size):
+                cur.executemany("REPLACE INTO cached_rows (scope, taken, measurement, value_type, value, value_text, unit) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [[scope] + list(row) for row in rows[i:i + batch_size]])
+                count += len(rows[i:i + batch_size])
+            if covered_from is not None:
+                cur.execute("UPDATE cache_scopes SET covered_from = ? WHERE id = ? AND (covered_from IS NULL OR covered_from > ?)", [covered_from, scope, covered_from])
+            self.connection.commit()
+        except self.backend.Error as e:
+            self.connection.rollback()
+            raise e
+        return count
+
+    def evict(self, scope):
+        # Remove rows older than max_age before the scope's newest row, then the oldest rows of all scopes
+        # while there are more than max_rows. The scopes' covered_from times move forward past what was removed.
+        cur = self.connection.cursor()
+        try:
+            cur.execute("SELECT MAX(taken) FROM cached_rows WHERE scope = ?", [scope])
+            (newest,) = cur.fetchone()
+            if newest is not None:
+                cutoff = newest - self.max_age
+                cur.execute("DELETE FROM cached_rows WHERE scope = ? AND taken < ?", [scope, cutoff])
+                cur.execute("UPDATE cache_scopes SET covered_from = ? WHERE id = ? AND covered_from < ?", [cutoff, scope, cutoff])
+
+            cur.execute("SELECT COUNT(*) FROM cached_rows")
+            (count,) = cur.fetchone()
+            if count > self.max_rows:
+                cur.execute("SELECT taken FROM cached_rows ORDER BY taken LIMIT 1 OFFSET ?", [count - self.max_rows])
+                (cutoff,) = cur.fetchone()
+                cur.execute("DELETE FROM cached_rows WHERE taken < ?", [cutoff])
+                cur.execute("UPDATE cache_scopes SET covered_from = ? WHERE covered_from < ?", [cutoff, cutoff])
+            self.connection.commit()
+        except self.backend.Error as e:
+            self.connection.rollback()
+            raise e
+
+
+fetch_cache_schema = """
+CREATE TABLE IF NOT EXISTS cache_scopes (
+	id           INTEGER      PRIMARY KEY AUTOINCREMENT,
+	measurements VARCHAR(100) NOT NULL UNIQUE,
+	covered_from DATETIME
+);
+
+CREATE TABLE IF NOT EXISTS cached_rows (
+	scope       INTEGER      NOT NULL,
+	taken       DATETIME     NOT NULL,
+	measurement VARCHAR(100) NOT NULL,
+	value_type  VARCHAR(10)  NOT NULL,
+	value,
+	value_text  VARCHAR(100),
+	unit        VARCHAR(20),
+	PRIMARY KEY (scope, measurement, taken)
+);
+CREATE INDEX IF NOT EXISTS cached_rows_taken ON cached_rows (scope, taken);
+CREATE INDEX IF NOT EXISTS cached_rows_eviction ON cached_rows (taken);
+"""
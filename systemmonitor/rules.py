@@ -5,9 +5,14 @@ from systemmonitor.common import *
 import re
 
 
+# Placeholders that can be used in rule messages
+message_placeholder_regex = re.compile(r'\{(VALUE|TYPE|UNIT|LATEST|WINDOW|\d+)\}')
+# Window conditions on a key, e.g. #avg(6) for the average of the last 6 samples, or #p95(1h) for the 95th percentile over the last hour
+window_regex = re.compile(r'#(avg|min|max|rate|p(\d+(?:\.\d+)?))\(([^)]+)\)$')
+
+
 class Rules():
 
-    rules = []
     comparators = {
         '<': lambda v1, v2: v1 < v2,
         '<=': lambda v1, v2: v1 <= v2,
@@ -17,6 +22,11 @@ class Rules():
         '!=': lambda v1, v2: v1 != v2,
     }
 
+    def __init__(self):
+        self.rules = []
+        # Trie of the literal prefixes of rule patterns - each node is (rule indexes, children by character)
+        self.index = ([], {})
+
     def import_rules(self, rules):
         for rule in rules:
             self.add_rule(rule[0], rule[1], rule[2], rule[3])
@@ -30,67 +40,284 @@ class Rules():
                 attribute = a
                 key_pattern = key_pattern[0: len(key_pattern) - len(a) - 1]
 
+        # If key ends in #function(window) then we will do the comparison against that
+        # function of the values in the window - a number of samples, or a duration
+        window = None
+        window_match = window_regex.search(key_pattern)
+        if window_match:
+            size = window_match.group(3).strip()
+            window = {
+                'function': 'percentile' if window_match.group(2) is not None else window_match.group(1),
+                'percentile': float(window_match.group(2)) if window_match.group(2) is not None else None,
+                'size': int(size) if size.isdigit() else parse_duration(size),
+            }
+            attribute = window_match.group(0)[1:]
+            key_pattern = key_pattern[0: window_match.start()]
+
+        # Only the part of the pattern after its literal prefix needs to be matched by regex
+        prefix = self.literal_prefix(key_pattern)
+        prefix_length = len(prefix)
+
+        # Resolve comparator, thresholds and message template now, rather than for every match
+        comparator = comparison
+        if not callable(comparator):
+            comparator = self.comparators[comparison]
+        thresholds = threshold
+        if type(thresholds) != tuple and type(thresholds) != list:
+            thresholds = [thresholds]
+        template = None
+        if not callable(message):
+            template = self.parse_message(message)
+
         self.rules.append({
             'pattern': re.compile(key_pattern),
+            'prefix_length': prefix_length,
+            'suffix_pattern': re.compile(self.pattern_after(key_pattern, prefix_length)),
             'comparison': comparison,
+            'comparator': comparator,
             'threshold': threshold,
+            'thresholds': list(reversed(thresholds)),
             'message': message,
+            'template': template,
             'attribute': attribute,
+            'window': window,
         })
 
+        node = self.index
+        for c in prefix:
+            node = node[1].setdefault(c, ([], {}))
+        node[0].append(len(self.rules) - 1)
+
+    def literal_prefix(self, pattern):
+        # The characters every key matching the pattern must start with
+        if self.has_top_level_alternation(pattern):
+            return ''
+        prefix = ''
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if c == '\\':
+                # Escaped punctuation is a literal, anything else (\d, \s...) is a class
+                if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                    break
+                literal = pattern[i + 1]
+                step = 2
+            elif c in '.^$*+?{}[]()|':
+                break
+            else:
+                literal = c
+                step = 1
+            # Stop at a literal followed by a quantifier, as it might not be there, or be repeated
+            if i + step < len(pattern) and pattern[i + step] in '*+?{':
+                break
+            prefix += literal
+            i += step
+        return prefix
+
+    def pattern_after(self, pattern, prefix_length):
+        # The rest of the pattern, after the characters that make up the first prefix_length literals
+        i = 0
+        for _ in range(prefix_length):
+            i += 2 if pattern[i] == '\\' else 1
+        return pattern[i:]
+
+    def has_top_level_alternation(self, pattern):
+        depth = 0
+        in_class = False
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if c == '\\':
+                i += 2
+                continue
+            if in_class:
+                if c == ']':
+                    in_class = False
+            elif c == '[':
+                in_class = True
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            elif c == '|' and depth == 0:
+                return True
+            i += 1
+        return False
+
+    def parse_message(self, message):
+        # Split message into literal strings, and placeholders - names of attributes, or group numbers
+        parts = []
+        position = 0
+        for placeholder in message_placeholder_regex.finditer(message):
+            if placeholder.start() > position:
+                parts.append((False, message[position:placeholder.start()]))
+            name = placeholder.group(1)
+            parts.append((True, int(name) if name.isdigit() else name.lower()))
+            position = placeholder.end()
+        if position < len(message):
+            parts.append((False, message[position:]))
+        return parts
+
+    def render_message(self, template, v, groups, window_value=None):
+        message = []
+        for (is_placeholder, part) in template:
+            if not is_placeholder:
+                message.append(part)
+            elif type(part) == int:
+                # Placeholders for groups that aren't in the pattern are left as they are
+                message.append(str(groups[part]) if part < len(groups) else '{' + str(part) + '}')
+            elif part == 'window':
+                message.append(str(window_value))
+            else:
+                message.append(str(getattr(v, part)))
+        return ''.join(message)
+
+    def window_values(self, window, measurements):
+        # The (times, values) in the window of each measurement, most recent last. Values that aren't numbers,
+        # such as dates and strings, are treated as no value.
+        windows = []
+        for v in measurements:
+            if v.values is not None:
+                items = [(t, value) for t, value in v.values.items() if isinstance(value, (int, float))]
+            elif isinstance(v.value, (int, float)):
+                items = [(v.latest, v.value)]
+            else:
+                items = []
+            if type(window['size']) == int:
+                items = items[-window['size']:]
+            elif len(items) > 0 and items[-1][0] is not None:
+                cutoff = items[-1][0] - window['size']
+                items = [(t, value) for t, value in items if t is not None and t >= cutoff]
+            windows.append(([t for t, _ in items], [float(value) for _, value in items]))
+        return windows
+
+    def window_aggregates(self, window, measurements):
+        # Work out the window function for all measurements at once. Returns None for any without enough values.
+        windows = self.window_values(window, measurements)
+        function = window['function']
+        results = [None] * len(windows)
+
+        if function == 'rate':
+            for i, (times, values) in enumerate(windows):
+                if len(values) >= 2 and times[0] is not None and times[-1] > times[0]:
+                    results[i] = (values[-1] - values[0]) / (times[-1] - times[0]).total_seconds()
+            return results
+
+        rows = [i for i, (_, values) in enumerate(windows) if len(values) > 0]
+        if len(rows) == 0:
+            return results
+
+        # numpy is only imported when a window rule is checked, as it's slow to import
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            # One row per measurement, padded with NaN so all rows are the same length
+            width = max([len(windows[i][1]) for i in rows])
+            matrix = numpy.full((len(rows), width), numpy.nan)
+            for row, i in enumerate(rows):
+                values = windows[i][1]
+                matrix[row, width - len(values):] = values
+            if function == 'avg':
+                aggregates = numpy.nanmean(matrix, axis=1)
+            elif function == 'min':
+                aggregates = numpy.nanmin(matrix, axis=1)
+            elif function == 'max':
+                aggregates = numpy.nanmax(matrix, axis=1)
+            else:
+                aggregates = numpy.nanpercentile(matrix, window['percentile'], axis=1)
+            for row, i in enumerate(rows):
+                results[i] = float(aggregates[row])
+            return results
+
+        for i in rows:
+            values = windows[i][1]
+            if function == 'avg':
+                results[i] = sum(values) / len(values)
+            elif function == 'min':
+                results[i] = min(values)
+            elif function == 'max':
+                results[i] = max(values)
+            else:
+                results[i] = self.percentile(values, window['percentile'])
+        return results
+
+    def percentile(self, values, percentile):
+        # Linear interpolation between closest ranks, as numpy does by default
+        values = sorted(values)
+        position = (len(values) - 1) * percentile / 100
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    def matching_rules(self, key):
+        # Indexes of rules whose literal prefix the key starts with
+        node = self.index
+        rule_indexes = list(node[0])
+        for c in key:
+            if c not in node[1]:
+                break
+            node = node[1][c]
+            rule_indexes += node[0]
+        return rule_indexes
+
     def check_rules(self, data):
         # Flatten the hierarchical keys
         flat_data = flatten_data(data)
+
+        # Find matching keys for each rule, using the prefix index
+        matches = [[] for _ in self.rules]
+        for k, v in flat_data.items():
+            for rule_index in self.matching_rules(k):
+                rule = self.rules[rule_index]
+                rule_match = rule['suffix_pattern'].fullmatch(k, rule['prefix_length'])
+                if rule_match:
+                    matches[rule_index].append((k, v, rule_match))
+
         broken_rules = []
-        for rule in self.rules:
+        for rule_index, rule in enumerate(self.rules):
             attribute = rule['attribute']
-            for k, v in flat_data.items():
-                rule_match = rule['pattern'].fullmatch(k)
-                if rule_match:
-                    # Step through all rule thresholds provided (most severe first) - if just one, put into a list
-                    rule_thresholds = rule['threshold']
-                    if type(rule_thresholds) != tuple and type(rule_thresholds) != list:
-                        rule_thresholds = [rule_thresholds]
-                    for level, rule_threshold in enumerate(reversed(rule_thresholds)):
-                        # If rule threshold is callable, resolve it
-                        if callable(rule_threshold):
-                            rule_threshold = rule_threshold(flat_data, rule_match.groups())
-                        # If comparator is not callable, get it from comparators map
-                        comparator = rule['comparison']
-                        if not callable(comparator):
-                            comparator = self.comparators[rule['comparison']]
-                        # Execute rule
+            comparator = rule['comparator']
+            rule_thresholds = rule['thresholds']
+            window_values = None
+            if rule['window'] is not None:
+                window_values = self.window_aggregates(rule['window'], [v for (k, v, rule_match) in matches[rule_index]])
+            for match_index, (k, v, rule_match) in enumerate(matches[rule_index]):
+                # Step through all rule thresholds provided (most severe first)
+                for level, rule_threshold in enumerate(rule_thresholds):
+                    # If rule threshold is callable, resolve it
+                    if callable(rule_threshold):
+                        rule_threshold = rule_threshold(flat_data, rule_match.groups())
+                    # Execute rule
+                    if window_values is not None:
+                        value_attribute = window_values[match_index]
+                    else:
                         value_attribute = getattr(v, attribute)
-                        # Error if value is None
-                        if value_attribute is None:
-                            broken = True
+                    # Error if value is None
+                    if value_attribute is None:
+                        broken = True
+                    else:
+                        broken = comparator(value_attribute, rule_threshold)
+                    if broken:
+                        # Construct message
+                        if rule['template'] is None:
+                            message = rule['message'](value_attribute, rule_match.groups())
                         else:
-                            broken = comparator(value_attribute, rule_threshold)
-                        if broken:
-                            # Construct message
-                            message = rule['message']
-                            if callable(message):
-                                message = message(value_attribute, rule_match.groups())
-                            else:
-                                message = message.replace('{VALUE}', str(v.value))
-                                message = message.replace('{TYPE}', str(v.type))
-                                message = message.replace('{UNIT}', str(v.unit))
-                                message = message.replace('{LATEST}', str(v.latest))
-                                for i, g in enumerate(rule_match.groups()):
-                                    message = message.replace('{' + str(i) + '}', str(g))
-                            # Add rule to list of broken rules
-                            broken_rules.append({
-                                'key': k,
-                                'value': v.value,
-                                'type': v.type,
-                                'unit': v.unit,
-                                'latest': v.latest,
-                                'comparison': rule['comparison'],
-                                'attribute': attribute,
-                                'rule_threshold': rule_threshold,
-                                'groups': rule_match.groups(),
-                                'message': message,
-                                'level': (len(rule_thresholds) - level - 1),
-                            })
-                            break
+                            message = self.render_message(rule['template'], v, rule_match.groups(), value_attribute)
+                        # Add rule to list of broken rules
+                        broken_rules.append({
+                            'key': k,
+                            'value': v.value,
+                            'type': v.type,
+                            'unit': v.unit,
+                            'latest': v.latest,
+                            'comparison': rule['comparison'],
+                            'attribute': attribute,
+                            'rule_threshold': rule_threshold,
+                            'groups': rule_match.groups(),
+                            'message': message,
+                            'level': (len(rule_thresholds) - level - 1),
+                        })
+                        break
         return broken_rules
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+from systemmonitor.common import *
+
+import fcntl
+
+
+class Spool():
+
+    # A local append-only file of samples, one JSON line per sample, that are waiting to be pushed to the database
+
+    def __init__(self, config):
+        self.filename = config.get('file', os.path.join(get_cache_dir(), 'spool'))
+        self.max_size = config.get('max_size', 100 * 1024 * 1024)
+        self.fsync_every = config.get('fsync_every', 10)
+        self.replay_samples = config.get('replay_samples', 100)
+        self.fh = None
+        self.unsynced = 0
+
+    def append(self, data, now):
+        line = json.dumps({
+            'taken': now,
+            'data': [[key, m.type, None if m.value is None else str(m.value), m.unit] for key, m in data.items()],
+        }, separators=(',', ':')) + "\n"
+
+        self.lock_current_file()
+        try:
+            if os.fstat(self.fh.fileno()).st_size + len(line) > self.max_size:
+                err("Spool is full, dropping sample taken at", now)
+                return False
+            self.fh.write(line)
+            self.fh.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_every:
+                self.sync()
+        finally:
+            fcntl.flock(self.fh, fcntl.LOCK_UN)
+        return True
+
+    def lock_current_file(self):
+        # The spool file can be moved away by replay at any time, so once locked, make sure it's still the current one
+        while True:
+            if self.fh is None:
+                self.fh = open(self.filename, 'a')
+            fcntl.flock(self.fh, fcntl.LOCK_EX)
+            try:
+                if os.stat(self.filename).st_ino == os.fstat(self.fh.fileno()).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self.sync()
+            fcntl.flock(self.fh, fcntl.LOCK_UN)
+            self.fh.close()
+            self.fh = None
+
+    def sync(self):
+        if self.unsynced > 0 and self.fh is not None:
+            os.fsync(self.fh.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        if self.fh is not None:
+            self.sync()
+            self.fh.close()
+            self.fh = None
+
+    def replay(self, database, verbose=False):
+        # Move the spool aside, then push its samples to the database in large batches.
+        # Progress is saved after each batch is committed, so a failed replay carries on where it left off.
+        # Samples the database won't take are moved to a separate file, so they don't hold up the rest.
+        replay_filename = self.filename + '.replaying'
+        offset_filename = self.filename + '.offset'
+        if not os.path.exists(replay_filename):
+            try:
+                with open(self.filename, 'r') as fh:
+                    fcntl.flock(fh, fcntl.LOCK_EX)
+                    os.rename(self.filename, replay_filename)
+            except FileNotFoundError:
+                return 0
+
+        offset = read_json_file(offset_filename, 0)
+        total = 0
+        with open(replay_filename, 'r') as fh:
+            fh.seek(offset)
+            while True:
+                samples = []
+                lines = []
+                for line in iter(fh.readline, ''):
+                    if not line.endswith("\n"):
+                        # Partly written line, from a crash while appending
+                        break
+                    sample = json.loads(line)
+                    samples.append((sample['taken'], dict([(key, Measurement(value, value_type, unit=unit)) for (key, value_type, value, unit) in sample['data']])))
+                    lines.append(line)
+                    if len(samples) >= self.replay_samples:
+                        break
+                if len(samples) == 0:
+                    break
+                try:
+                    stats = database.push_samples(samples, replay=True)
+                except Exception as e:
+                    stats = self.push_each(database, samples, lines, e)
+                write_json_file(offset_filename, fh.tell())
+                total += len(samples)
+                if verbose:
+                    err("Replayed {} samples ({rows} measurements in {batches} batches in {seconds:.3f}s)".format(len(samples), **stats))
+
+        os.remove(replay_filename)
+        if os.path.exists(offset_filename):
+            os.remove(offset_filename)
+        return total
+
+    def push_each(self, database, samples, lines, error):
+        # Push a batch that failed one sample at a time. A sample that fails while the database can be connected
+        # to is moved to the failed file, otherwise the error is raised so the batch is tried again later.
+        failed_filename = self.filename + '.failed'
+        stats = {'rows': 0, 'batches': 0, 'seconds': 0}
+        for (sample, line) in zip(samples, lines):
+            try:
+                sample_stats = database.push_samples([sample], replay=True)
+            except Exception as e:
+                try:
+                    if database.push_connection is None:
+                        database.connect_push()
+                    database.disconnect_push()
+                except Exception:
+                    raise error
+                err("Could not replay sample taken at {}, moving it to {}: {}".format(sample[0], failed_filename, e))
+                with open(failed_filename, 'a') as fh:
+                    fh.write(line)
+                continue
+            for stat in stats.keys():
+                stats[stat] += sample_stats[stat]
+        return stats